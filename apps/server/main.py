@@ -4,20 +4,43 @@ import yaml
 import uvicorn
 import httpx
 import time
+import random
 import shutil
+import sqlite3
+import stat
+import tempfile
+import contextlib
+import urllib.parse
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import hashlib
+import math
+import struct
+from array import array
 from uuid import uuid4
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import asyncio
+from collections import deque, OrderedDict
 from typing import Optional, List, Dict, Any
 import psutil
 from fastapi import WebSocket, WebSocketDisconnect
 from starlette.requests import Request
-from starlette.responses import Response
+from starlette.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
 import logging
 from logging.handlers import RotatingFileHandler
 
+# brotli compression for proxied controller responses (requirements.txt),
+# responses fall back to gzip on installs without it
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 app = FastAPI()
 start_time = time.time()
 
@@ -58,7 +81,37 @@ DEFAULT_CONFIG = {
     "advanced": {
         "delay_test_concurrency": 15,
         "delay_test_timeout": 2500,
-        "subscription_update_interval": 24
+        "subscription_update_interval": 24,
+        "controller_pool_max_connections": 100,
+        "controller_pool_max_keepalive": 20,
+        "controller_pool_keepalive_expiry": 30,
+        "controller_proxy_streaming": True,
+        "controller_etag_paths": ["proxies", "rules", "connections", "configs", "providers/proxies"],
+        "controller_compress_min_size": 1024,
+        "controller_cache_ttl": {"proxies": 1.0, "configs": 2.0, "rules": 10.0, "connections": 0.5},
+        "process_rescan_interval": 60,
+        "metrics_sample_interval": 2,
+        "metrics_history_size": 150,
+        "latency_history_size": 128,
+        "unlock_test_concurrency": 8,
+        "unlock_matrix_cache_ttl": 21600,
+        "profile_update_concurrency": 6,
+        "profile_update_per_host": 2,
+        "profile_update_backoff_base": 60,
+        "profile_update_backoff_max": 3600,
+        "profile_download_mode": "race",
+        "profile_download_race_delay": 0.3,
+        "io_threads": 4,
+        "profile_cache_size": 4,
+        "rendered_config_cache_size": 8,
+        "core_ready_timeout": 10,
+        "core_log_lines": 500,
+        "core_swap_mode": "blue_green",
+        "core_swap_mixed_port": 17890,
+        "core_swap_controller_port": 19190,
+        "core_swap_drain": 10,
+        "index_backup": True,
+        "index_backend": "json"
     }
 }
 
@@ -117,6 +170,7 @@ CONFIG_DIR = os.getenv("CLASH_CONFIG_DIR", os.path.expanduser(clash_config_dir))
 CONFIG_PATH = os.path.join(CONFIG_DIR, "config.yaml")
 PROFILES_DIR = os.path.join(CONFIG_DIR, "profiles")
 PROFILES_INDEX = os.path.join(CONFIG_DIR, "profiles.json")
+PROFILES_DB = os.path.join(CONFIG_DIR, "profiles.db")
 
 # Ensure Directories
 if not os.path.exists(PROFILES_DIR):
@@ -163,6 +217,10 @@ class Profile(BaseModel):
     auto_update: Optional[bool] = False
     use_system_proxy: Optional[bool] = False
     allow_unsafe: Optional[bool] = False
+    # Validators for conditional refresh
+    etag: Optional[str] = ""
+    last_modified: Optional[str] = ""
+    content_hash: Optional[str] = ""
 
 class ProfileUpdate(BaseModel):
     name: Optional[str] = None
@@ -202,48 +260,46 @@ class ProfilesIndex(BaseModel):
 
 @app.post("/preferences")
 async def update_preferences(prefs: Dict[str, Any]):
-    index = load_index()
-    if index.preferences is None:
-        index.preferences = Preferences()
-    
-    # Update preferences
-    cur_prefs = index.preferences.dict()
-    for k, v in prefs.items():
-        if k in cur_prefs:
-            cur_prefs[k] = v
-    
-    index.preferences = Preferences(**cur_prefs)
-    save_index(index)
-    
-    # Apply system proxy if changed
-    if "system_proxy" in prefs:
-        set_system_proxy(prefs["system_proxy"], index.preferences.mixed_port)
+    # Where the core listens now, it only moves once it reloads config.yaml
+    previous_endpoint = get_controller_endpoint()
+    async with mutate_index() as index:
+        if index.preferences is None:
+            index.preferences = Preferences()
+        
+        # Update preferences
+        cur_prefs = index.preferences.dict()
+        for k, v in prefs.items():
+            if k in cur_prefs:
+                cur_prefs[k] = v
+        
+        old_prefs = index.preferences
+        index.preferences = Preferences(**cur_prefs)
+        changed = diff_preferences(old_prefs, index.preferences)
+        
+        # Apply to config.yaml if a profile is selected, in the same order as the saves
+        config_changed = False
+        if index.selected:
+            try:
+                profile = next(p for p in index.profiles if p.id == index.selected)
+                file_path = os.path.join(PROFILES_DIR, profile.file)
+                if os.path.exists(file_path):
+                    # Merge logic
+                    config_changed = await run_blocking(apply_profile_config, file_path, index.preferences)
+            except Exception as e:
+                print(f"Failed to write merged config: {e}")
+    invalidate_controller_endpoint()
     
-    # Apply to config.yaml if a profile is selected
-    if index.selected:
-        try:
-            profile = next(p for p in index.profiles if p.id == index.selected)
-            file_path = os.path.join(PROFILES_DIR, profile.file)
-            if os.path.exists(file_path):
-                with open(file_path, "r", encoding="utf-8") as f:
-                    config = yaml.safe_load(f)
-                
-                # Merge logic
-                config = inject_config_overrides(config, index.preferences)
-                
-                with open(CONFIG_PATH, "w", encoding="utf-8") as f:
-                    yaml.safe_dump(config, f)
-                
-                await reload_clash_config()
-        except: pass
+    # Patch, reload or restart the core, whichever is enough
+    decision = await apply_config_changes(index.preferences, changed, config_changed, profile_changed=False, reason="preferences",
+                                          previous_endpoint=previous_endpoint)
         
-    return {"success": True, "preferences": index.preferences}
+    return {"success": True, "preferences": index.preferences, "apply": decision}
 
 @app.get("/proxy_geoip")
 async def get_proxy_geoip():
     """Fetch GeoIP info through the local Clash proxy (port 7890)"""
     # Use the mixed_port from preferences or default to 7890
-    index = load_index()
+    index = get_index()
     proxy_port = index.preferences.mixed_port if index.preferences else 7890
     
     proxy_url = f"http://127.0.0.1:{proxy_port}"
@@ -279,6 +335,39 @@ async def get_system_info():
 class AutoStartRequest(BaseModel):
     enable: bool
 
+def install_auto_start_services(user_systemd_dir: str, core_service_path: str, web_service_path: str,
+                                core_content: str, web_content: str):
+    if not os.path.exists(user_systemd_dir):
+        os.makedirs(user_systemd_dir, exist_ok=True)
+    with open(core_service_path, "w") as f:
+        f.write(core_content)
+    with open(web_service_path, "w") as f:
+        f.write(web_content)
+
+    # 3. Enable & Start
+    os.system("systemctl --user daemon-reload")
+    os.system("systemctl --user enable clash.service")
+    os.system("systemctl --user enable clashwebui.service")
+    # 不自动启动,避免中断当前会话
+
+    # 4. Enable lingering
+    user = os.environ.get("USER")
+    if user:
+        os.system(f"loginctl enable-linger {user}")
+
+def remove_auto_start_services(core_service_path: str, web_service_path: str):
+    os.system("systemctl --user stop clashwebui.service")
+    os.system("systemctl --user stop clash.service")
+    os.system("systemctl --user disable clashwebui.service")
+    os.system("systemctl --user disable clash.service")
+
+    if os.path.exists(web_service_path):
+        os.remove(web_service_path)
+    if os.path.exists(core_service_path):
+        os.remove(core_service_path)
+
+    os.system("systemctl --user daemon-reload")
+
 @app.post("/auto_start")
 async def set_auto_start(req: AutoStartRequest):
     """
@@ -290,7 +379,7 @@ async def set_auto_start(req: AutoStartRequest):
     core_service_path = os.path.join(user_systemd_dir, "clash.service")
     
     # 获取配置
-    index = load_index()
+    index = get_index()
     prefs = index.preferences
     
     # Clash 路径
@@ -304,9 +393,6 @@ async def set_auto_start(req: AutoStartRequest):
     
     if req.enable:
         try:
-            if not os.path.exists(user_systemd_dir):
-                os.makedirs(user_systemd_dir, exist_ok=True)
-            
             # 1. Clash Core Service
             core_content = f"""[Unit]
 Description=Clash Core Service
@@ -321,8 +407,6 @@ RestartSec=5
 [Install]
 WantedBy=default.target
 """
-            with open(core_service_path, "w") as f:
-                f.write(core_content)
             
             # 2. WebUI Service
             backend_port = prefs.backend_port if prefs else 3000
@@ -342,19 +426,9 @@ Environment=WEBUI_PORT={backend_port}
 [Install]
 WantedBy=default.target
 """
-            with open(web_service_path, "w") as f:
-                f.write(web_content)
-            
-            # 3. Enable & Start
-            os.system("systemctl --user daemon-reload")
-            os.system("systemctl --user enable clash.service")
-            os.system("systemctl --user enable clashwebui.service")
-            # 不自动启动,避免中断当前会话
-            
-            # 4. Enable lingering
-            user = os.environ.get("USER")
-            if user:
-                os.system(f"loginctl enable-linger {user}")
+            # systemctl and the unit files run on the I/O pool
+            await run_blocking(install_auto_start_services, user_systemd_dir, core_service_path, web_service_path,
+                               core_content, web_content)
             
             return {"success": True, "enabled": True}
             
@@ -363,17 +437,7 @@ WantedBy=default.target
     else:
         # Disable
         try:
-            os.system("systemctl --user stop clashwebui.service")
-            os.system("systemctl --user stop clash.service")
-            os.system("systemctl --user disable clashwebui.service")
-            os.system("systemctl --user disable clash.service")
-            
-            if os.path.exists(web_service_path):
-                os.remove(web_service_path)
-            if os.path.exists(core_service_path):
-                os.remove(core_service_path)
-            
-            os.system("systemctl --user daemon-reload")
+            await run_blocking(remove_auto_start_services, core_service_path, web_service_path)
             
             return {"success": True, "enabled": False}
         except Exception as e:
@@ -384,7 +448,8 @@ async def get_auto_start_status():
     """获取自启状态"""
     import subprocess
     try:
-        result = subprocess.run(
+        result = await run_blocking(
+            subprocess.run,
             ["systemctl", "--user", "is-enabled", "clashwebui.service"],
             capture_output=True,
             text=True
@@ -394,6 +459,204 @@ async def get_auto_start_status():
     except:
         return {"enabled": False}
 # Helpers
+
+# --- Blocking I/O ---
+# File, YAML and subprocess work runs here so it never stalls the event loop
+# (and with it every WebSocket stream and proxied API call)
+io_executor = ThreadPoolExecutor(
+    max_workers=APP_CONFIG.get("advanced", {}).get("io_threads", 4),
+    thread_name_prefix="io"
+)
+
+async def run_blocking(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_executor, functools.partial(func, *args, **kwargs))
+
+def read_text_file(path: str) -> str:
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+def write_text_file(path: str, content: str, backup: bool = False):
+    durable_write(path, content.encode("utf-8"), backup=backup)
+
+def durable_write(path: str, data: bytes, backup: bool = False):
+    """
+    Crash-safe replace of path: the data goes to a temp file in the same
+    directory and is fsynced before the rename, so after a power loss the file
+    holds either the old or the new content, never a truncated mix.
+    With backup=True the previous version is kept as path + ".bak".
+    """
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode))
+        except OSError:
+            # mkstemp creates 0600 files, new files get the usual mode
+            os.chmod(tmp_path, 0o644)
+        if backup and os.path.exists(path):
+            # Hard link the current generation, no copy and atomic on rename
+            bak_tmp = f"{tmp_path}.bak"
+            try:
+                os.link(path, bak_tmp)
+            except OSError:
+                shutil.copy2(path, bak_tmp)
+            os.replace(bak_tmp, f"{path}.bak")
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+    fsync_dir(directory)
+
+def fsync_dir(directory: str):
+    """Persist renames in directory (not supported on Windows)"""
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+# --- YAML ---
+# LibYAML bindings are an order of magnitude faster on multi-MB subscriptions
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+yaml_timings = deque(maxlen=100)
+
+def record_yaml_timing(op: str, label: str, started: float, size: int):
+    yaml_timings.append({
+        "op": op,
+        "label": label,
+        "ms": round((time.perf_counter() - started) * 1000, 2),
+        "size": size,
+        "time": time.time()
+    })
+
+def parse_yaml(content: str, label: str = ""):
+    started = time.perf_counter()
+    data = yaml.load(content, Loader=YAML_LOADER)
+    record_yaml_timing("parse", label, started, len(content))
+    return data
+
+def dump_yaml(data, label: str = "") -> str:
+    started = time.perf_counter()
+    content = yaml.dump(data, Dumper=YAML_DUMPER)
+    record_yaml_timing("dump", label, started, len(content))
+    return content
+
+class LRUCache:
+    """Small thread-safe LRU, used from the I/O pool"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return self.items[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > max(0, self.capacity):
+                self.items.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"size": len(self.items), "capacity": self.capacity, "hits": self.hits, "misses": self.misses}
+
+# (path, mtime, size) -> parsed profile, shared: never mutate
+parsed_profile_cache = LRUCache(APP_CONFIG.get("advanced", {}).get("profile_cache_size", 4))
+# ((path, mtime, size), preferences hash) -> merged config.yaml text
+rendered_config_cache = LRUCache(APP_CONFIG.get("advanced", {}).get("rendered_config_cache_size", 8))
+
+def profile_file_key(file_path: str) -> tuple:
+    stat = os.stat(file_path)
+    return (file_path, stat.st_mtime_ns, stat.st_size)
+
+def load_profile_config(file_path: str):
+    """Parsed profile, served from the cache while the file is unchanged. Do not mutate."""
+    key = profile_file_key(file_path)
+    config = parsed_profile_cache.get(key)
+    if config is None:
+        config = parse_yaml(read_text_file(file_path), os.path.basename(file_path))
+        parsed_profile_cache.put(key, config)
+    return config
+
+def write_clash_config(config: dict):
+    write_text_file(CONFIG_PATH, dump_yaml(config, "config.yaml"))
+
+def render_profile_config(file_path: str, prefs: Optional[Preferences]) -> str:
+    """Merged config.yaml text for a profile and the current preferences"""
+    # Only the fields inject_config_overrides reads, other preferences don't change the output
+    overrides = {k: getattr(prefs, k) for k in CONFIG_PREFERENCE_FIELDS} if prefs else None
+    prefs_hash = hashlib.sha256(json.dumps(overrides, sort_keys=True).encode()).hexdigest()
+    key = (profile_file_key(file_path), prefs_hash)
+    content = rendered_config_cache.get(key)
+    if content is None:
+        config = load_profile_config(file_path)
+        if prefs:
+            # inject_config_overrides only sets top-level keys and rewrites "dns"/"tun",
+            # copying those levels keeps the cached document intact
+            config = dict(config)
+            for section in ("dns", "tun"):
+                if isinstance(config.get(section), dict):
+                    config[section] = dict(config[section])
+            config = inject_config_overrides(config, prefs)
+        content = dump_yaml(config, "config.yaml")
+        rendered_config_cache.put(key, content)
+    return content
+
+def apply_profile_config(file_path: str, prefs: Optional[Preferences]) -> bool:
+    """Write the merged config.yaml, returns False when it already had that content"""
+    content = render_profile_config(file_path, prefs)
+    try:
+        if read_text_file(CONFIG_PATH) == content:
+            return False
+    except OSError:
+        pass
+    write_text_file(CONFIG_PATH, content)
+    return True
+
+@app.get("/yaml/stats")
+def get_yaml_stats():
+    # Appended to from the I/O pool, work on a copy
+    timings = list(yaml_timings)
+    totals = {}
+    for t in timings:
+        total = totals.setdefault(t["op"], {"count": 0, "ms": 0.0, "size": 0})
+        total["count"] += 1
+        total["ms"] = round(total["ms"] + t["ms"], 2)
+        total["size"] += t["size"]
+    return {
+        "libyaml": YAML_LOADER is not yaml.SafeLoader,
+        "profile_cache": parsed_profile_cache.stats(),
+        "rendered_cache": rendered_config_cache.stats(),
+        "totals": totals,
+        "recent": timings[::-1]
+    }
+
+# Preferences read by inject_config_overrides
+CONFIG_PREFERENCE_FIELDS = ("mixed_port", "external_controller", "secret", "allow_lan", "ipv6", "tun_mode")
+
 def inject_config_overrides(config: dict, prefs: Preferences):
     """
     Centralized logic to inject global preferences into Clash config.
@@ -430,84 +693,856 @@ def inject_config_overrides(config: dict, prefs: Preferences):
             
     return config
 
-def set_system_proxy(enable: bool, port: int = 7890):
+# --- Core Supervisor ---
+class CoreSupervisor:
     """
-    控制 Clash 进程来实现系统代理的启用/禁用
-    启用 = 启动 Clash
-    禁用 = 停止 Clash
+    Owns the Clash core as a child process: spawns it, waits until the controller
+    answers /version, keeps its output in a ring buffer and restarts it with
+    backoff when it exits on its own.
     """
-    print(f"[Info] System Proxy: {enable} - Controlling Clash process")
-    
-    try:
-        import subprocess
-        
+
+    def __init__(self, log_lines: int = 500):
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.output = deque(maxlen=log_lines)
+        self.lock = asyncio.Lock()
+        self.wanted = False # Should be running
+        self.state = "stopped" # stopped, starting, running, crashed, failed
+        self.spawned_at: Optional[float] = None
+        self.ready_ms: Optional[float] = None
+        self.restarts = 0
+        self.crashes = 0 # Consecutive, reset once a core stays up
+        self.last_exit: Optional[int] = None
+        self.endpoint: Optional["ControllerEndpoint"] = None # Controller of the running core
+        self.monitor_task: Optional[asyncio.Task] = None
+        self.swaps = 0
+        self.last_swap: Optional[Dict[str, Any]] = None
+        self.readers: Dict[int, asyncio.Task] = {} # pid -> output reader
+        self.retire_task: Optional[asyncio.Task] = None # Drain of the swapped-out core
+        self.children: Dict[int, asyncio.subprocess.Process] = {} # Every core we spawned, incl. draining ones
+        self.staged_path = os.path.join(CONFIG_DIR, "config.staged.yaml")
+
+    def command(self) -> List[str]:
         # 从 preferences 获取自定义路径
-        index = load_index()
+        index = get_index()
         if index.preferences:
             clash_bin = os.path.expanduser(index.preferences.clash_binary_path or "~/.bin/clash")
             clash_config_dir = os.path.expanduser(index.preferences.clash_config_dir or "~/.config/clash")
         else:
             clash_bin = os.path.expanduser("~/.bin/clash")
             clash_config_dir = os.path.expanduser("~/.config/clash")
-            
-        clash_log = os.path.expanduser("~/clash.log")
-        
+        return [clash_bin, "-d", clash_config_dir]
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self) -> Dict[str, Any]:
+        """(Re)start the core and wait until its controller is ready"""
+        async with self.lock:
+            self.wanted = True
+            await self._stop()
+            await self._spawn()
+            return self.status()
+
+    async def stop(self) -> Dict[str, Any]:
+        global controller_endpoint_override
+        async with self.lock:
+            self.wanted = False
+            await self._stop()
+            # A core started elsewhere later on listens where the config says
+            controller_endpoint_override = None
+            return self.status()
+
+    async def launch(self, cmd: List[str]) -> asyncio.subprocess.Process:
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            start_new_session=True
+        )
+        print(f"[Info] Clash started (pid {process.pid}): {' '.join(cmd)}")
+        self.children[process.pid] = process
+        self.readers[process.pid] = asyncio.create_task(self.read_output(process))
+        return process
+
+    async def _spawn(self):
+        global controller_endpoint_override
+        self.state = "starting"
+        self.ready_ms = None
+        self.spawned_at = time.monotonic()
+        try:
+            self.process = await self.launch(self.command())
+        except Exception as e:
+            self.state = "failed"
+            self.output.append((time.time(), f"[supervisor] spawn failed: {e}"))
+            print(f"Failed to start Clash: {e}")
+            return
+        self.monitor_task = asyncio.create_task(self.monitor(self.process))
+
+        # Plain start reads config.yaml, so the configured controller applies
+        controller_endpoint_override = None
+        invalidate_controller_endpoint()
+        self.endpoint = get_controller_endpoint()
+        timeout = APP_CONFIG.get("advanced", {}).get("core_ready_timeout", 10)
+        if await self.wait_ready(self.process, self.endpoint, timeout):
+            self.state = "running"
+            self.ready_ms = round((time.monotonic() - self.spawned_at) * 1000, 1)
+            print(f"[Info] Clash ready in {self.ready_ms}ms")
+        elif self.is_alive():
+            print(f"[Warn] Clash did not answer /version within {timeout}s")
+
+    async def wait_ready(self, process: asyncio.subprocess.Process, endpoint: "ControllerEndpoint", timeout: float, client: Optional[httpx.AsyncClient] = None) -> bool:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and process.returncode is None:
+            if await core_is_reachable(endpoint, client):
+                return True
+            await asyncio.sleep(0.05)
+        return False
+
+    async def swap(self) -> bool:
+        """
+        Blue/green restart: start a second core from config.yaml on spare ports, move the
+        mixed port over once its controller answers, let the old core drain and stop it.
+        Returns False (nothing changed) when the caller should fall back to a restart.
+        """
+        global controller_endpoint_override
+        advanced = APP_CONFIG.get("advanced", {})
+        # The previous green core owns the spare ports until its drain ends
+        await self.settle()
+        async with self.lock:
+            if not self.is_alive() or self.endpoint is None:
+                return False
+            if self.draining() or controller_endpoint_override is not None:
+                # Still on the spare controller port, a restart moves it back
+                return False
+            config = await run_blocking(lambda: parse_yaml(read_text_file(CONFIG_PATH), "config.yaml"))
+            if (config.get("tun") or {}).get("enable"):
+                # Two cores can't own the TUN device at once
+                return False
+
+            prefs = get_index().preferences or Preferences()
+            green_endpoint = make_controller_endpoint(f"127.0.0.1:{advanced.get('core_swap_controller_port', 19190)}", config.get("secret"))
+            staged = dict(config)
+            staged["mixed-port"] = advanced.get("core_swap_mixed_port", 17890)
+            staged["external-controller"] = green_endpoint.http_url.replace("http://", "", 1)
+            for key in ("port", "socks-port", "redir-port", "tproxy-port"):
+                staged.pop(key, None)
+            if isinstance(staged.get("dns"), dict):
+                # The DNS listener stays with the old core until the final reload
+                staged["dns"] = {k: v for k, v in staged["dns"].items() if k != "listen"}
+            staged_path = self.staged_path
+            await run_blocking(write_text_file, staged_path, dump_yaml(staged, "config.staged.yaml"))
+
+            started = time.monotonic()
+            blue, blue_endpoint = self.process, self.endpoint
+            async with httpx.AsyncClient(timeout=5.0) as client:
+                try:
+                    green = await self.launch(self.command() + ["-f", staged_path])
+                except Exception as e:
+                    print(f"Blue/green swap: failed to start new core: {e}")
+                    await self.remove_staged_config()
+                    return False
+                timeout = advanced.get("core_ready_timeout", 10)
+                if not await self.wait_ready(green, green_endpoint, timeout, client):
+                    print("Blue/green swap: new core not ready, keeping the old one")
+                    await self.terminate(green)
+                    await self.remove_staged_config()
+                    return False
+                ready_ms = round((time.monotonic() - started) * 1000, 1)
+
+                # Cut over: old core lets go of the mixed port, new core takes it
+                async def set_mixed_port(endpoint: "ControllerEndpoint", port: int) -> bool:
+                    try:
+                        resp = await client.patch(f"{endpoint.http_url}/configs", json={"mixed-port": port}, headers=endpoint.auth_headers)
+                        return resp.status_code == 204
+                    except Exception:
+                        return False
+
+                if not await set_mixed_port(blue_endpoint, 0) or not await set_mixed_port(green_endpoint, prefs.mixed_port):
+                    print("Blue/green swap: cutover failed, keeping the old core")
+                    await set_mixed_port(blue_endpoint, prefs.mixed_port)
+                    await self.terminate(green)
+                    await self.remove_staged_config()
+                    return False
+
+            self.process = green
+            self.endpoint = green_endpoint
+            self.spawned_at = started
+            self.ready_ms = ready_ms
+            self.state = "running"
+            self.swaps += 1
+            if self.monitor_task:
+                self.monitor_task.cancel()
+            self.monitor_task = asyncio.create_task(self.monitor(green))
+            controller_endpoint_override = green_endpoint
+            invalidate_controller_cache()
+
+            drain = advanced.get("core_swap_drain", 10)
+            self.last_swap = {"time": time.time(), "ready_ms": ready_ms, "drain": drain, "old_pid": blue.pid, "new_pid": green.pid}
+            print(f"Blue/green swap: cut over to pid {green.pid} in {ready_ms}ms, draining pid {blue.pid} for {drain}s")
+            self.retire_task = asyncio.create_task(self.retire(blue, drain))
+            return True
+
+    def draining(self) -> bool:
+        return self.retire_task is not None and not self.retire_task.done()
+
+    async def settle(self):
+        """Wait until a swapped-out core finished draining and the controller moved home"""
+        if self.draining():
+            await asyncio.shield(self.retire_task)
+
+    async def retire(self, process: asyncio.subprocess.Process, drain: float):
+        """Stop a swapped-out core after the grace period, then move the controller home"""
+        global controller_endpoint_override
+        await asyncio.sleep(drain)
+        await self.terminate(process)
+        async with self.lock:
+            if self.endpoint is not controller_endpoint_override or not self.is_alive():
+                return
+            # Old core released the configured controller and DNS ports. Reloading config.yaml
+            # re-creates the controller there (see CONTROLLER_PREFERENCE_FIELDS)
+            final_endpoint = resolve_controller_endpoint(get_index())
+            async with httpx.AsyncClient(timeout=10.0) as client:
+                try:
+                    await client.put(f"{self.endpoint.http_url}/configs", json={"path": CONFIG_PATH}, headers=self.endpoint.auth_headers)
+                except Exception as e:
+                    print(f"Blue/green swap: final reload failed: {e}")
+                if await self.wait_ready(self.process, final_endpoint, 5, client):
+                    self.endpoint = final_endpoint
+                    controller_endpoint_override = None
+                    invalidate_controller_endpoint()
+                    invalidate_controller_cache()
+                    # Running from config.yaml now, the staged copy (with the secret) can go
+                    await self.remove_staged_config()
+                    print("Blue/green swap: controller back on its configured address")
+                else:
+                    print(f"Blue/green swap: controller stays on {self.endpoint.http_url}")
+
+    async def remove_staged_config(self):
+        try:
+            await run_blocking(os.remove, self.staged_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Failed to remove {self.staged_path}: {e}")
+
+    async def terminate(self, process: asyncio.subprocess.Process):
+        if process.returncode is None:
+            process.terminate()
+            try:
+                await asyncio.wait_for(process.wait(), 5)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+        self.children.pop(process.pid, None)
+        reader = self.readers.pop(process.pid, None)
+        if reader:
+            reader.cancel()
+
+    async def shutdown(self):
+        """
+        Backend exit: stop the cores we spawned. Their output goes through pipes
+        this process reads, a core left behind would die of SIGPIPE on its next
+        log line. Cores started elsewhere are left alone.
+        """
+        self.wanted = False
+        if self.monitor_task:
+            self.monitor_task.cancel()
+            self.monitor_task = None
+        children = list(self.children.values())
+        if children:
+            await asyncio.gather(*(self.terminate(process) for process in children), return_exceptions=True)
+            await self.remove_staged_config()
+            print(f"[Info] Stopped {len(children)} Clash process(es) on shutdown")
+        self.process = None
+        self.state = "stopped"
+
+    async def _stop(self):
+        if self.monitor_task:
+            self.monitor_task.cancel()
+            self.monitor_task = None
+        if self.draining():
+            # The swapped-out core still holds the configured controller and DNS ports
+            self.retire_task.cancel()
+            self.retire_task = None
+            for process in list(self.children.values()):
+                if process is not self.process:
+                    await self.terminate(process)
+        if self.is_alive():
+            await self.terminate(self.process)
+            self.last_exit = self.process.returncode
+            # Left over when the core is stopped during a swap drain
+            await self.remove_staged_config()
+            print("[Info] Clash stopped")
+        elif self.process is None:
+            # A core we don't own (earlier backend run, manual start) would hold the ports
+            try:
+                result = await asyncio.create_subprocess_exec("pkill", "-x", os.path.basename(self.command()[0]))
+                if await result.wait() == 0:
+                    print("[Info] Stopped a Clash instance not started by this backend")
+            except Exception as e:
+                print(f"Failed to stop foreign Clash instance: {e}")
+        self.process = None
+        self.state = "stopped"
+
+    async def read_output(self, process: asyncio.subprocess.Process):
+        try:
+            while True:
+                line = await process.stdout.readline()
+                if not line:
+                    break
+                self.output.append((time.time(), line.decode("utf-8", "replace").rstrip()))
+        finally:
+            if self.readers.get(process.pid) is asyncio.current_task():
+                self.readers.pop(process.pid, None)
+                self.children.pop(process.pid, None)
+
+    async def monitor(self, process: asyncio.subprocess.Process):
+        """Restart the core with backoff when it exits without being asked to"""
+        code = await process.wait()
+        if self.process is not process or not self.wanted:
+            return
+        self.last_exit = code
+        self.state = "crashed"
+        # A core that stayed up for a minute starts the backoff over
+        if self.spawned_at and time.monotonic() - self.spawned_at > 60:
+            self.crashes = 0
+        self.crashes += 1
+        delay = min(30, 2 ** (self.crashes - 1))
+        print(f"[Warn] Clash exited with {code}, restarting in {delay}s")
+        self.output.append((time.time(), f"[supervisor] exited with {code}, restart in {delay}s"))
+        await asyncio.sleep(delay)
+        async with self.lock:
+            if self.wanted and self.process is process:
+                self.restarts += 1
+                self.process = None
+                await self._spawn()
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "pid": self.process.pid if self.is_alive() else None,
+            "uptime": round(time.monotonic() - self.spawned_at, 1) if self.is_alive() and self.spawned_at else None,
+            "ready_ms": self.ready_ms,
+            "restarts": self.restarts,
+            "last_exit": self.last_exit,
+            "controller": self.endpoint.http_url if self.endpoint else None,
+            "swaps": self.swaps,
+            "last_swap": self.last_swap,
+            "command": self.command()
+        }
+
+core_supervisor = CoreSupervisor(
+    log_lines=APP_CONFIG.get("advanced", {}).get("core_log_lines", 500)
+)
+
+async def set_system_proxy(enable: bool, port: int = 7890):
+    """
+    控制 Clash 进程来实现系统代理的启用/禁用
+    启用 = 启动 Clash
+    禁用 = 停止 Clash
+    """
+    print(f"[Info] System Proxy: {enable} - Controlling Clash process")
+    try:
         if enable:
-            # 启用系统代理 = 启动 Clash
-            # 1. 先停止已存在的实例
-            subprocess.run(["pkill", "clash"], capture_output=True)
-            time.sleep(0.5)  # 等待进程完全停止
-            
-            # 2. 启动新实例
-            cmd = f"nohup {clash_bin} -d {clash_config_dir} > {clash_log} 2>&1 &"
-            subprocess.Popen(cmd, shell=True, 
-                           stdout=subprocess.DEVNULL, 
-                           stderr=subprocess.DEVNULL,
-                           start_new_session=True)
-            print(f"[Info] Clash started: {clash_bin} -d {clash_config_dir}")
+            await core_supervisor.start()
         else:
-            # 禁用系统代理 = 停止 Clash
-            result = subprocess.run(["pkill", "clash"], capture_output=True)
-            if result.returncode == 0:
-                print("[Info] Clash stopped")
-            else:
-                print("[Info] Clash was not running")
-                
+            await core_supervisor.stop()
     except Exception as e:
         print(f"Failed to control Clash process: {e}")
 
+@app.get("/core/status")
+def get_core_status():
+    return core_supervisor.status()
+
+@app.get("/core/logs")
+def get_core_logs(lines: int = 200):
+    return {"lines": [{"time": t, "line": line} for t, line in list(core_supervisor.output)[-lines:]]}
+
+
+# Controller HTTP Client
+# A single keep-alive client is shared by everything that talks to the Clash
+# controller. It is only rebuilt when the controller address or secret changes.
+controller_client: Optional[httpx.AsyncClient] = None
+controller_client_key: Optional[tuple] = None
+
+class ControllerEndpoint(BaseModel):
+    """Resolved address and credentials of the Clash external controller"""
+    http_url: str
+    ws_url: str
+    secret: str = ""
+    auth_headers: Dict[str, str] = {}
+    token_query: str = ""
+
+    def ws_target(self, path: str, params: Optional[Dict[str, str]] = None) -> str:
+        """Upstream WebSocket URL for path, with the auth token and extra query params"""
+        query = [self.token_query] if self.token_query else []
+        if params:
+            query.append(urllib.parse.urlencode({k: v for k, v in params.items() if k != "token"}))
+        query = "&".join(q for q in query if q)
+        if not query:
+            return f"{self.ws_url}/{path}"
+        separator = "&" if "?" in path else "?"
+        return f"{self.ws_url}/{path}{separator}{query}"
+
+controller_endpoint: Optional[ControllerEndpoint] = None
+# Set while the active core runs on a spare controller port (blue/green swap)
+controller_endpoint_override: Optional[ControllerEndpoint] = None
+
+def resolve_controller_endpoint(index: "ProfilesIndex") -> ControllerEndpoint:
+    default_host = APP_CONFIG["clash"].get("controller_host", "127.0.0.1")
+    default_port = APP_CONFIG["ports"].get("clash_controller", 9090)
+    default_secret = APP_CONFIG["clash"].get("secret", "")
 
-def load_index() -> ProfilesIndex:
-    if not os.path.exists(PROFILES_INDEX):
-        return ProfilesIndex(profiles=[], selected=None, preferences=Preferences())
+    controller = f"{default_host}:{default_port}"
+    secret = default_secret
+
+    if index.preferences:
+        controller = index.preferences.external_controller or controller
+        secret = index.preferences.secret or secret
+
+    return make_controller_endpoint(controller, secret)
+
+def make_controller_endpoint(controller: str, secret: Optional[str]) -> ControllerEndpoint:
+    # Normalize secret
+    secret = str(secret).strip() if secret is not None else ""
+
+    # Ensure protocol
+    controller = controller.rstrip("/")
+    if not controller.startswith("http"):
+        controller = f"http://{controller}"
+    ws_controller = controller.replace("http://", "ws://", 1).replace("https://", "wss://", 1)
+
+    return ControllerEndpoint(
+        http_url=controller,
+        ws_url=ws_controller,
+        secret=secret,
+        auth_headers={"Authorization": f"Bearer {secret}"} if secret else {},
+        token_query=f"token={urllib.parse.quote(secret, safe='')}" if secret else ""
+    )
+
+def get_controller_endpoint() -> ControllerEndpoint:
+    """Controller endpoint, resolved once and reused until preferences change"""
+    global controller_endpoint
+    if controller_endpoint_override is not None:
+        return controller_endpoint_override
+    if controller_endpoint is None:
+        controller_endpoint = resolve_controller_endpoint(get_index())
+    return controller_endpoint
+
+def invalidate_controller_endpoint():
+    global controller_endpoint
+    controller_endpoint = None
+
+def controller_pool_limits() -> httpx.Limits:
+    advanced = APP_CONFIG.get("advanced", {})
+    return httpx.Limits(
+        max_connections=advanced.get("controller_pool_max_connections", 100),
+        max_keepalive_connections=advanced.get("controller_pool_max_keepalive", 20),
+        keepalive_expiry=advanced.get("controller_pool_keepalive_expiry", 30)
+    )
+
+async def get_controller_client(endpoint: ControllerEndpoint) -> httpx.AsyncClient:
+    global controller_client, controller_client_key
+
+    key = (endpoint.http_url, endpoint.secret)
+    if controller_client is None or controller_client_key != key:
+        old_client = controller_client
+        controller_client = httpx.AsyncClient(
+            verify=False,
+            timeout=10.0,
+            trust_env=False,
+            limits=controller_pool_limits()
+        )
+        controller_client_key = key
+        logger.info(f"Controller client pool created for {endpoint.http_url}")
+        if old_client is not None:
+            # Requests may still be in flight on the old pool, close it once they had time to finish
+            asyncio.create_task(close_controller_client_later(old_client))
+    return controller_client
+
+async def close_controller_client_later(client: httpx.AsyncClient, delay: float = 15.0):
+    await asyncio.sleep(delay)
+    await client.aclose()
+
+async def close_controller_client():
+    global controller_client, controller_client_key
+    if controller_client is not None:
+        await controller_client.aclose()
+    controller_client = None
+    controller_client_key = None
+
+# Controller Response Cache
+# Short-lived cache in front of hot GET endpoints. Concurrent identical requests
+# share one in-flight upstream call, any write through the proxy clears it.
+controller_cache: Dict[tuple, tuple] = {}
+controller_inflight: Dict[tuple, asyncio.Future] = {}
+controller_cache_generation = 0
+
+def invalidate_controller_cache():
+    global controller_cache_generation
+    controller_cache.clear()
+    # Fetches started before the write must not repopulate the cache
+    controller_cache_generation += 1
+
+async def fetch_controller_cached(key: tuple, ttl: float, fetch) -> tuple:
+    """Return (status_code, body, headers) for key, calling fetch() at most once per TTL"""
+    entry = controller_cache.get(key)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+
+    pending = controller_inflight.get(key)
+    if pending is not None:
+        return await asyncio.shield(pending)
+
+    future = asyncio.get_running_loop().create_future()
+    controller_inflight[key] = future
+    generation = controller_cache_generation
     try:
-        with open(PROFILES_INDEX, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        if "preferences" not in data:
-            data["preferences"] = Preferences().dict()
-        return ProfilesIndex(**data)
-    except Exception as e:
-        print(f"Error loading index: {e}")
-        return ProfilesIndex(profiles=[], selected=None, preferences=Preferences())
+        result = await fetch()
+        if result[0] == 200 and generation == controller_cache_generation:
+            controller_cache[key] = (time.monotonic() + ttl, result)
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        # Mark as retrieved, there may be no other waiter
+        future.exception()
+        raise
+    finally:
+        controller_inflight.pop(key, None)
 
-def save_index(index: ProfilesIndex):
-    with open(PROFILES_INDEX, "w", encoding="utf-8") as f:
+
+# Profiles Index Cache
+# profiles.json is parsed once and then served from memory. save_index writes
+# through the cache, out-of-band edits are picked up by watch_index_file().
+index_cache: Optional[ProfilesIndex] = None
+index_cache_mtime: Optional[int] = None
+
+def index_file_mtime() -> Optional[int]:
+    try:
+        return os.stat(PROFILES_INDEX).st_mtime_ns
+    except OSError:
+        return None
+
+def parse_index_file(path: str) -> ProfilesIndex:
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if "preferences" not in data:
+        data["preferences"] = Preferences().dict()
+    return ProfilesIndex(**data)
+
+def quarantine_index_file():
+    """Move an unreadable profiles.json aside so the next save can't overwrite it"""
+    corrupt_path = f"{PROFILES_INDEX}.corrupt-{time.time_ns()}"
+    try:
+        os.replace(PROFILES_INDEX, corrupt_path)
+        print(f"Unreadable index kept as {corrupt_path}")
+    except OSError as e:
+        print(f"Failed to move unreadable index aside: {e}")
+
+def read_index_file() -> ProfilesIndex:
+    backup_path = f"{PROFILES_INDEX}.bak"
+    if os.path.exists(PROFILES_INDEX):
+        try:
+            return parse_index_file(PROFILES_INDEX)
+        except Exception as e:
+            print(f"Error loading index: {e}")
+            quarantine_index_file()
+    if os.path.exists(backup_path):
+        try:
+            index = parse_index_file(backup_path)
+            print(f"Index restored from {backup_path}")
+            return index
+        except Exception as e:
+            print(f"Error loading index backup: {e}")
+    return ProfilesIndex(profiles=[], selected=None, preferences=Preferences())
+
+def get_index() -> ProfilesIndex:
+    """
+    Shared in-memory index for read-only hot paths (no disk access).
+    The returned object must not be modified, use load_index() for that.
+    """
+    global index_cache, index_cache_mtime
+    if index_cache is None:
+        index_cache_mtime = index_store.mtime()
+        index_cache = index_store.load()
+    return index_cache
+
+# (index, {profile id -> profile}) for the cached index it was built from
+index_profile_map: tuple = (None, {})
+
+def get_profile(profile_id: str) -> Optional[Profile]:
+    """Lookup by id on the shared index, same read-only rules as get_index()"""
+    global index_profile_map
+    index = get_index()
+    built_for, by_id = index_profile_map
+    if built_for is not index:
+        by_id = {p.id: p for p in index.profiles}
+        index_profile_map = (index, by_id)
+    return by_id.get(profile_id)
+
+def load_index() -> ProfilesIndex:
+    """Private copy of the index, request handlers modify it through mutate_index()"""
+    return get_index().model_copy(deep=True)
+
+# Serializes writers of profiles.json across the loop and worker threads
+index_file_lock = threading.Lock()
+# Held while an offloaded write is pending, in write order
+index_write_lock = asyncio.Lock()
+
+def write_index_file(index: ProfilesIndex):
+    with index_file_lock:
         # Dump using pydantic's dict method
-        f.write(json.dumps(index.dict(), indent=2, ensure_ascii=False))
+        content = json.dumps(index.dict(), indent=2, ensure_ascii=False)
+        write_text_file(
+            PROFILES_INDEX, content,
+            backup=APP_CONFIG.get("advanced", {}).get("index_backup", True)
+        )
+
+class JsonIndexStore:
+    """
+    profiles.json, rewritten in full on every save. Hand edits are picked up.
+    Switching back from sqlite exports profiles.db on first use.
+    """
+    watchable = True
+
+    def load(self) -> ProfilesIndex:
+        if not os.path.exists(PROFILES_INDEX) and os.path.exists(PROFILES_DB):
+            return self.migrate()
+        return read_index_file()
+
+    def migrate(self) -> ProfilesIndex:
+        store = SqliteIndexStore(PROFILES_DB)
+        try:
+            index = store.load()
+        finally:
+            store.close()
+        self.save(index)
+        # profiles.json is the source of truth again, a later switch to sqlite re-imports it
+        migrated_path = f"{PROFILES_DB}.migrated"
+        os.replace(PROFILES_DB, migrated_path)
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(PROFILES_DB + suffix):
+                os.remove(PROFILES_DB + suffix)
+        print(f"Exported {len(index.profiles)} profiles to {PROFILES_INDEX}, database kept as {migrated_path}")
+        return index
+
+    def save(self, index: ProfilesIndex):
+        write_index_file(index)
+
+    def mtime(self) -> Optional[int]:
+        return index_file_mtime()
+
+    def close(self):
+        pass
+
+class SqliteIndexStore:
+    """
+    profiles.db in WAL mode with one row per profile, for setups with hundreds of
+    subscriptions. save() diffs against what it last wrote and only touches the
+    rows that changed, so a usage refresh is a single-row UPDATE instead of a
+    rewrite of every profile. An existing profiles.json is imported on first use.
+    """
+    watchable = False
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = None
+        self.lock = threading.Lock()
+        # What the database holds: profile id -> (position, json), meta key -> json
+        self.rows: Dict[str, tuple] = {}
+        self.meta: Dict[str, str] = {}
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            # Commits are fsynced like the JSON writes
+            self.conn.execute("PRAGMA synchronous=FULL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS profiles "
+                "(id TEXT PRIMARY KEY, position INTEGER NOT NULL, data TEXT NOT NULL)"
+            )
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        return self.conn
+
+    def load(self) -> ProfilesIndex:
+        with self.lock:
+            conn = self.connect()
+            self.rows = {
+                row[0]: (row[1], row[2])
+                for row in conn.execute("SELECT id, position, data FROM profiles ORDER BY position")
+            }
+            self.meta = dict(conn.execute("SELECT key, value FROM meta"))
+        if not self.meta and os.path.exists(PROFILES_INDEX):
+            return self.migrate()
+        preferences = self.meta.get("preferences")
+        return ProfilesIndex(
+            profiles=[Profile.model_validate_json(data) for _, data in self.rows.values()],
+            selected=json.loads(self.meta.get("selected", "null")),
+            preferences=Preferences.model_validate_json(preferences) if preferences and preferences != "null" else Preferences()
+        )
+
+    def migrate(self) -> ProfilesIndex:
+        index = read_index_file()
+        self.save(index)
+        # The database is the source of truth from now on
+        migrated_path = f"{PROFILES_INDEX}.migrated"
+        if os.path.exists(PROFILES_INDEX):
+            os.replace(PROFILES_INDEX, migrated_path)
+        # Older than the database from now on, must never be restored over it
+        backup_path = f"{PROFILES_INDEX}.bak"
+        if os.path.exists(backup_path):
+            os.remove(backup_path)
+        print(f"Migrated {len(index.profiles)} profiles to {self.path}, old index kept as {migrated_path}")
+        return index
+
+    def save(self, index: ProfilesIndex):
+        rows = {}
+        last_position = -1
+        for profile in index.profiles:
+            # Keep stored positions while the order holds, deletes leave gaps
+            position = self.rows.get(profile.id, (None,))[0]
+            if position is None or position <= last_position:
+                position = last_position + 1
+            last_position = position
+            # Serialized by pydantic-core, this diff runs over every profile on each save
+            rows[profile.id] = (position, profile.model_dump_json())
+        meta = {
+            "selected": json.dumps(index.selected),
+            "preferences": index.preferences.model_dump_json() if index.preferences else "null"
+        }
+        with self.lock:
+            conn = self.connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                removed = [(profile_id,) for profile_id in self.rows if profile_id not in rows]
+                changed = [
+                    (profile_id, position, data)
+                    for profile_id, (position, data) in rows.items()
+                    if self.rows.get(profile_id) != (position, data)
+                ]
+                conn.executemany("DELETE FROM profiles WHERE id = ?", removed)
+                conn.executemany(
+                    "INSERT INTO profiles (id, position, data) VALUES (?, ?, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET position = excluded.position, data = excluded.data",
+                    changed
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                    [(k, v) for k, v in meta.items() if self.meta.get(k) != v]
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            self.rows = rows
+            self.meta = meta
+
+    def mtime(self) -> Optional[int]:
+        return None
 
-async def download_profile_content(url: str) -> Dict[str, Any]:
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+def make_index_store():
+    backend = APP_CONFIG.get("advanced", {}).get("index_backend", "json")
+    if backend == "sqlite":
+        return SqliteIndexStore(PROFILES_DB)
+    return JsonIndexStore()
+
+index_store = make_index_store()
+
+def save_index(index: ProfilesIndex):
+    global index_cache, index_cache_mtime
+    index_store.save(index)
+    index_cache = index.model_copy(deep=True)
+    index_cache_mtime = index_store.mtime()
+
+async def save_index_async(index: ProfilesIndex):
+    """save_index() with the file write done on the I/O pool"""
+    global index_cache, index_cache_mtime
+    # Readers see the new index right away, the file catches up in order
+    snapshot = index.model_copy(deep=True)
+    index_cache = snapshot
+    async with index_write_lock:
+        await run_blocking(index_store.save, snapshot)
+        if index_cache is snapshot:
+            index_cache_mtime = index_store.mtime()
+
+# Serializes load -> modify -> save of the index. Without it two handlers that
+# interleave across an await start from the same copy and the later save
+# silently drops the other's change.
+index_mutation_lock = asyncio.Lock()
+
+@contextlib.asynccontextmanager
+async def mutate_index():
+    """Private copy of the latest index, saved on exit unless the block raises"""
+    async with index_mutation_lock:
+        index = load_index()
+        yield index
+        await save_index_async(index)
+
+async def watch_index_file(interval: float = 2.0):
+    """Background task picking up edits of profiles.json made outside the WebUI"""
+    global index_cache, index_cache_mtime
+    if not index_store.watchable:
+        return
+    unreadable_mtime = None
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if index_write_lock.locked():
+                # Our own write in flight
+                continue
+            mtime = index_file_mtime()
+            if index_cache is None or mtime is None or mtime == index_cache_mtime:
+                continue
+            try:
+                index = parse_index_file(PROFILES_INDEX)
+            except Exception as e:
+                # Possibly an editor caught mid-save: keep the last good index and
+                # try again next tick. Only the loader moves broken files aside.
+                if mtime != unreadable_mtime:
+                    print(f"profiles.json changed on disk but is unreadable, keeping the current index: {e}")
+                    unreadable_mtime = mtime
+                continue
+            print("profiles.json changed on disk, reloading index")
+            index_cache, index_cache_mtime = index, mtime
+            invalidate_controller_endpoint()
+        except Exception as e:
+            print(f"Error in index watcher: {e}")
+
+# Host -> route ("direct" / "proxy") that last delivered its subscription
+profile_download_routes: Dict[str, str] = {}
+
+def profile_content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+async def download_profile_content(url: str, etag: str = "", last_modified: str = "", extract_name: bool = True) -> Dict[str, Any]:
     """
     Robust download:
-    1. Try direct download (bypass system proxy).
-    2. Try proxy via 127.0.0.1:7890 if direct fails.
-    Returns: {"content": str, "usage": dict}
+    1. Hosts with a known route use it first and fall back to the other one.
+    2. Otherwise race direct (bypass system proxy) against the mixed port proxy,
+       the first success wins and the slower attempt is cancelled.
+    Sends If-None-Match / If-Modified-Since when validators are given.
+    Returns: {"content": str, "usage": dict, "not_modified": bool, "etag": str, "last_modified": str}
     """
     
     headers = {
         "User-Agent": "clash-verge/1.3.8"
     }
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
     
     usage = {"used": 0, "total": 0}
+    # Parsed subscription, kept when name extraction had to parse it
+    parsed = {}
 
     async def _extract_usage(resp):
         usage_str = resp.headers.get("subscription-userinfo", "")
@@ -556,8 +1591,8 @@ async def download_profile_content(url: str) -> Dict[str, Any]:
         Many subscription services embed their brand name in the first proxy group.
         """
         try:
-            import yaml
-            config = yaml.safe_load(content)
+            config = parse_yaml(content, "subscription")
+            parsed["config"] = config
             
             # Method 1: Check proxy-groups for brand names
             proxy_groups = config.get('proxy-groups', [])
@@ -679,99 +1714,258 @@ async def download_profile_content(url: str) -> Dict[str, Any]:
                 pass
         return None
 
-    # 1. Direct Attempt
-    print(f"Attempting direct download: {url}")
-    try:
-        async with httpx.AsyncClient(trust_env=False, timeout=30.0, headers=headers, follow_redirects=True) as client:
+    async def _build_result(resp):
+        not_modified = resp.status_code == 304
+        content = None if not_modified else resp.text
+        return {
+            "content": content, 
+            "usage": await _extract_usage(resp),
+            # Name extraction may parse the YAML, only do it when asked
+            "name": await run_blocking(_extract_name, resp, url, content) if extract_name and not not_modified else None,
+            "interval": _extract_interval(resp),
+            "not_modified": not_modified,
+            "config": parsed.get("config"),
+            "etag": resp.headers.get("etag", etag if not_modified else ""),
+            "last_modified": resp.headers.get("last-modified", last_modified if not_modified else "")
+        }
+
+    index = get_index()
+    proxy_port = index.preferences.mixed_port if index.preferences else 7890
+    proxy_url = f"http://127.0.0.1:{proxy_port}"
+
+    async def _fetch(route: str):
+        print(f"Attempting {route} download: {url}")
+        if route == "direct":
+            client = httpx.AsyncClient(trust_env=False, timeout=30.0, headers=headers, follow_redirects=True)
+        else:
+            client = httpx.AsyncClient(proxy=proxy_url, timeout=30.0, headers=headers, follow_redirects=True)
+        async with client:
             resp = await client.get(url)
-            resp.raise_for_status()
-            content = resp.text
-            return {
-                "content": content, 
-                "usage": await _extract_usage(resp),
-                "name": _extract_name(resp, url, content),
-                "interval": _extract_interval(resp)
-            }
-    except Exception as e:
-        print(f"Direct download failed: {repr(e)}. Retrying with proxy...")
-    
-    # 2. Proxy Attempt
-    print(f"Attempting proxy download: {url}")
+            if resp.status_code != 304:
+                resp.raise_for_status()
+            return await _build_result(resp)
+
+    host = urllib.parse.urlparse(url).hostname or ""
+    advanced = APP_CONFIG.get("advanced", {})
+    preferred = profile_download_routes.get(host)
+    errors = {}
+
+    # 1. A route already won for this host: use it, fall back to the other one
+    if preferred or advanced.get("profile_download_mode", "race") != "race":
+        order = ["proxy", "direct"] if preferred == "proxy" else ["direct", "proxy"]
+        for route in order:
+            try:
+                result = await _fetch(route)
+                profile_download_routes[host] = route
+                return result
+            except Exception as e:
+                print(f"{route.capitalize()} download failed: {repr(e)}")
+                errors[route] = e
+        profile_download_routes.pop(host, None)
+        raise HTTPException(status_code=502, detail=f"Download failed: {str(errors[order[-1]])}")
+
+    # 2. Unknown host: race direct and proxy, proxy starts after a short head start
+    async def _delayed_proxy():
+        await asyncio.sleep(advanced.get("profile_download_race_delay", 0.3))
+        return await _fetch("proxy")
+
+    tasks = {
+        asyncio.create_task(_fetch("direct")): "direct",
+        asyncio.create_task(_delayed_proxy()): "proxy"
+    }
+    pending = set(tasks)
     try:
-        async with httpx.AsyncClient(proxy="http://127.0.0.1:7890", timeout=30.0, headers=headers, follow_redirects=True) as client:
-            resp = await client.get(url)
-            resp.raise_for_status()
-            content = resp.text
-            return {
-                "content": content, 
-                "usage": await _extract_usage(resp),
-                "name": _extract_name(resp, url, content),
-                "interval": _extract_interval(resp)
-            }
-    except Exception as e:
-        print(f"Proxy download failed: {repr(e)}")
-        raise HTTPException(status_code=502, detail=f"Download failed: {str(e)}")
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                route = tasks[task]
+                if task.exception() is None:
+                    print(f"{route.capitalize()} download won for {host}")
+                    profile_download_routes[host] = route
+                    return task.result()
+                print(f"{route.capitalize()} download failed: {repr(task.exception())}")
+                errors[route] = task.exception()
+    finally:
+        # Cancel the loser
+        for task in pending:
+            task.cancel()
+    raise HTTPException(status_code=502, detail=f"Download failed: {str(errors.get('proxy') or errors.get('direct'))}")
+
 async def perform_profile_update(profile_id: str) -> bool:
     """Common logic to update a remote profile"""
     try:
-        index = load_index()
-        try:
-            profile = next(p for p in index.profiles if p.id == profile_id)
-            idx = index.profiles.index(profile)
-        except StopIteration:
+        profile = get_profile(profile_id)
+        if profile is None:
             print(f"Profile {profile_id} not found during update")
             return False
 
         if profile.type == 'remote' and profile.url:
             print(f"Updating profile: {profile.name}")
-            result = await download_profile_content(profile.url)
-            yaml_content = result["content"]
-            usage_data = result["usage"]
-            
-            # Update name if it was generic "Profile *" or empty
-            if profile.name.startswith("Profile ") and result.get("name"):
-                 profile.name = result.get("name")
-            if result.get("interval"):
-                 profile.interval = result.get("interval")
-            
             file_path = os.path.join(PROFILES_DIR, profile.file)
+            # Validators are only usable while we still hold the body they describe
+            has_file = os.path.exists(file_path)
+            result = await download_profile_content(
+                profile.url,
+                etag=profile.etag if has_file else "",
+                last_modified=profile.last_modified if has_file else "",
+                extract_name=profile.name.startswith("Profile ")
+            )
             
-            with open(file_path, "w", encoding="utf-8") as f:
-                f.write(yaml_content)
-
-            profile.updated = time.time() * 1000
-            profile.usage = usage_data
+            # Only the fields owned by the update are written back, edits made
+            # while the download was in flight (rename, interval) are kept
+            changes = {}
+            if result.get("interval"):
+                 changes["interval"] = result.get("interval")
             
-            # Refresh index to avoid race conditions
-            current_index = load_index()
-            for i, p in enumerate(current_index.profiles):
-                if p.id == profile_id:
-                    current_index.profiles[i] = profile
-                    break
+            if result["not_modified"]:
+                print(f"Profile {profile.name} not modified (304)")
+            else:
+                yaml_content = result["content"]
+                content_hash = profile_content_hash(yaml_content)
+                if has_file and content_hash == profile.content_hash:
+                    print(f"Profile {profile.name} content unchanged, skipping write")
+                else:
+                    await run_blocking(write_text_file, file_path, yaml_content)
+                    changes["content_hash"] = content_hash
+
+            changes["etag"] = result["etag"]
+            changes["last_modified"] = result["last_modified"]
+            changes["updated"] = time.time() * 1000
+            # 304s don't always repeat subscription-userinfo
+            if result["usage"] or not result["not_modified"]:
+                changes["usage"] = result["usage"]
             
-            save_index(current_index)
+            async with mutate_index() as current_index:
+                current = next((p for p in current_index.profiles if p.id == profile_id), None)
+                if current is None:
+                    print(f"Profile {profile_id} was deleted during update")
+                    return False
+                # Update name if it is still generic "Profile *" or empty
+                if current.name.startswith("Profile ") and result.get("name"):
+                    changes["name"] = result.get("name")
+                for field, value in changes.items():
+                    setattr(current, field, value)
+                profile = current
             print(f"Profile {profile.name} updated successfully")
             return True
     except Exception as e:
         print(f"Failed to update profile {profile_id}: {e}")
     return False
 
+class ProfileUpdateScheduler:
+    """
+    Dispatches due auto-updates concurrently. A global cap plus a per-host cap keep
+    one slow provider from holding up the others, failed profiles back off
+    exponentially (with jitter) before the next attempt.
+    """
+
+    def __init__(self, history_size: int = 20):
+        self.inflight: Dict[str, float] = {} # profile id -> dispatch time
+        self.failures: Dict[str, int] = {}
+        self.retry_at: Dict[str, float] = {}
+        self.runs = deque(maxlen=history_size)
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.host_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def host_semaphore(self, host: str) -> asyncio.Semaphore:
+        if host not in self.host_semaphores:
+            limit = APP_CONFIG.get("advanced", {}).get("profile_update_per_host", 2)
+            self.host_semaphores[host] = asyncio.Semaphore(max(1, limit))
+        return self.host_semaphores[host]
+
+    def is_due(self, profile: Profile, now: float) -> bool:
+        if profile.type != 'remote' or not profile.auto_update or (profile.interval or 0) <= 0:
+            return False
+        if profile.id in self.inflight or now < self.retry_at.get(profile.id, 0):
+            return False
+        # interval is in minutes
+        return now * 1000 - profile.updated > profile.interval * 60 * 1000
+
+    def backoff(self, profile_id: str) -> float:
+        advanced = APP_CONFIG.get("advanced", {})
+        base = advanced.get("profile_update_backoff_base", 60)
+        cap = advanced.get("profile_update_backoff_max", 3600)
+        failures = self.failures[profile_id] = self.failures.get(profile_id, 0) + 1
+        delay = min(cap, base * 2 ** (failures - 1))
+        # Jitter so profiles that failed together don't retry together
+        return delay * random.uniform(0.5, 1.0)
+
+    async def update(self, profile: Profile) -> Dict[str, Any]:
+        host = urllib.parse.urlparse(profile.url or "").hostname or ""
+        queued = time.time()
+        try:
+            async with self.semaphore, self.host_semaphore(host):
+                started = time.time()
+                print(f"Auto-updating profile: {profile.name}")
+                ok = await perform_profile_update(profile.id)
+            finished = time.time()
+
+            entry = {
+                "id": profile.id,
+                "name": profile.name,
+                "host": host,
+                "ok": ok,
+                "wait": round(started - queued, 3),
+                "duration": round(finished - started, 3)
+            }
+            if ok:
+                self.failures.pop(profile.id, None)
+                self.retry_at.pop(profile.id, None)
+            else:
+                delay = self.backoff(profile.id)
+                self.retry_at[profile.id] = finished + delay
+                entry["retry_in"] = round(delay, 1)
+            return entry
+        finally:
+            # Reported as in flight only while its own update runs, not the whole batch
+            self.inflight.pop(profile.id, None)
+
+    async def run_batch(self, profiles: List[Profile]):
+        started = time.time()
+        results = await asyncio.gather(*(self.update(p) for p in profiles))
+        finished = time.time()
+        self.runs.append({
+            "started": started,
+            "finished": finished,
+            "duration": round(finished - started, 3),
+            "updated": sum(1 for r in results if r["ok"]),
+            "failed": sum(1 for r in results if not r["ok"]),
+            "profiles": sorted(results, key=lambda r: -r["duration"])
+        })
+
+    def dispatch(self):
+        if self.semaphore is None:
+            limit = APP_CONFIG.get("advanced", {}).get("profile_update_concurrency", 6)
+            self.semaphore = asyncio.Semaphore(max(1, limit))
+
+        now = time.time()
+        due = [p for p in get_index().profiles if self.is_due(p, now)]
+        if not due:
+            return
+        for p in due:
+            self.inflight[p.id] = now
+        # Not awaited, profiles that become due meanwhile go out on the next tick
+        asyncio.create_task(self.run_batch(due))
+
+    def report(self) -> Dict[str, Any]:
+        now = time.time()
+        return {
+            "inflight": [{"id": pid, "elapsed": round(now - t, 3)} for pid, t in list(self.inflight.items())],
+            "backoff": {
+                pid: {"failures": self.failures.get(pid, 0), "retry_in": round(max(0, t - now), 1)}
+                for pid, t in list(self.retry_at.items())
+            },
+            "runs": list(reversed(self.runs))
+        }
+
+profile_updater = ProfileUpdateScheduler()
+
 async def schedule_profile_updates():
     """Background task to check for auto-updates"""
     print("Starting profile auto-update scheduler...")
     while True:
         try:
-            index = load_index()
-            now = time.time() * 1000 # ms
-            
-            for profile in index.profiles:
-                if profile.type == 'remote' and profile.auto_update and profile.interval > 0:
-                    # interval is in minutes
-                    interval_ms = profile.interval * 60 * 1000
-                    if now - profile.updated > interval_ms:
-                        print(f"Auto-updating profile: {profile.name}")
-                        await perform_profile_update(profile.id)
-                        
+            profile_updater.dispatch()
         except Exception as e:
             print(f"Error in update scheduler: {e}")
             
@@ -780,7 +1974,7 @@ async def schedule_profile_updates():
 # Routes
 @app.get("/profiles")
 def get_profiles():
-    return load_index()
+    return get_index()
 
 @app.post("/profiles")
 async def import_profile(data: ProfileImport):
@@ -791,10 +1985,16 @@ async def import_profile(data: ProfileImport):
         profile_url = data.url or ""
         profile_id = str(uuid4())
         interval = 1440 # Default 24h
+        etag = last_modified = ""
+        profile_config = None
         
         if data.type == "remote" and data.url:
             result = await download_profile_content(data.url)
             yaml_content = result["content"]
+            # Already parsed if the name had to come from the YAML
+            profile_config = result["config"]
+            etag = result["etag"]
+            last_modified = result["last_modified"]
             usage_data = result["usage"]
             if not profile_name:
                 profile_name = result.get("name")
@@ -805,18 +2005,17 @@ async def import_profile(data: ProfileImport):
             profile_name = "New Profile"
         
         # Validate YAML
-        try:
-            yaml.safe_load(yaml_content)
-        except yaml.YAMLError:
-            raise HTTPException(status_code=400, detail="Invalid YAML content")
+        if profile_config is None:
+            try:
+                profile_config = await run_blocking(parse_yaml, yaml_content, "import")
+            except yaml.YAMLError:
+                raise HTTPException(status_code=400, detail="Invalid YAML content")
 
         file_name = f"{profile_id}.yaml"
         file_path = os.path.join(PROFILES_DIR, file_name)
         
-        with open(file_path, "w", encoding="utf-8") as f:
-            f.write(yaml_content)
+        await run_blocking(write_text_file, file_path, yaml_content)
             
-        index = load_index()
         new_profile = Profile(
             id=profile_id,
             name=profile_name,
@@ -826,42 +2025,38 @@ async def import_profile(data: ProfileImport):
             updated=time.time() * 1000,
             usage=usage_data,
             interval=interval,
-            auto_update=True if data.type == "remote" else False
+            auto_update=True if data.type == "remote" else False,
+            etag=etag,
+            last_modified=last_modified,
+            content_hash=profile_content_hash(yaml_content)
         )
         
-        index.profiles.append(new_profile)
-        
-        # 如果是第一个配置文件，自动应用它
-        first_profile = len(index.profiles) == 1
-        if first_profile:
-            index.selected = profile_id
+        # Save before applying, the config apply doesn't need the index lock
+        async with mutate_index() as index:
+            index.profiles.append(new_profile)
             
+            # 如果是第一个配置文件，自动应用它
+            first_profile = len(index.profiles) == 1
+            if first_profile:
+                index.selected = profile_id
+
+        if first_profile:
             # Apply Logic (Duplicate of select_profile logic, consider refactoring if complex)
             # 1. Merge Prefs
             try:
-                # Load YAML
-                # import yaml <--- REMOVED
-                profile_config = yaml.safe_load(yaml_content)
-                
                 # Inject
                 if index.preferences:
                     profile_config = inject_config_overrides(profile_config, index.preferences)
                 
                 # Write global config
-                with open(CONFIG_PATH, "w", encoding="utf-8") as f:
-                    yaml.safe_dump(profile_config, f)
+                await run_blocking(write_clash_config, profile_config)
                     
-                # Reload Core (Async inside sync function? No, import_profile is async)
-                await reload_clash_config()
-                
-                # Set System Proxy if needed
-                if index.preferences:
-                     set_system_proxy(index.preferences.system_proxy, index.preferences.mixed_port)
+                # Reload Core, or start it if the system proxy wants it running
+                await apply_config_changes(index.preferences or Preferences(), [], True, profile_changed=True, reason="import")
                      
             except Exception as e:
                 print(f"Failed to auto-apply imported profile: {e}")
 
-        save_index(index)
         return {"success": True, "profile": new_profile}
 
     except HTTPException:
@@ -871,210 +2066,830 @@ async def import_profile(data: ProfileImport):
         print(f"Import Profile Failed: {e}\n{traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Import failed: {str(e)}")
 
+@app.get("/profiles/update_report")
+async def get_profile_update_report():
+    return profile_updater.report()
+
 @app.put("/profiles/{profile_id}")
 async def update_profile(profile_id: str):
     success = await perform_profile_update(profile_id)
     if success:
-        index = load_index()
-        profile = next(p for p in index.profiles if p.id == profile_id)
-        return {"success": True, "profile": profile}
+        return {"success": True, "profile": get_profile(profile_id)}
     else:
         raise HTTPException(status_code=500, detail="Failed to update profile")
 
 @app.patch("/profiles/{profile_id}")
 async def patch_profile(profile_id: str, diff: ProfileUpdate):
-    index = load_index()
-    target = None
-    for p in index.profiles:
-        if p.id == profile_id:
-            target = p
-            break
-            
-    if not target:
-        raise HTTPException(status_code=404, detail="Profile not found")
-
-    # Update fields
-    update_data = diff.dict(exclude_unset=True)
-    # Update object in place or replace
-    # We construct a new Profile object with updated fields
-    target_dict = target.dict()
-    target_dict.update(update_data)
-    updated_profile = Profile(**target_dict)
-    
-    # Replace in list
-    index.profiles = [updated_profile if p.id == profile_id else p for p in index.profiles]
-    save_index(index)
+    async with mutate_index() as index:
+        target = None
+        for p in index.profiles:
+            if p.id == profile_id:
+                target = p
+                break
+                
+        if not target:
+            raise HTTPException(status_code=404, detail="Profile not found")
+
+        # Update fields
+        update_data = diff.dict(exclude_unset=True)
+        # Update object in place or replace
+        # We construct a new Profile object with updated fields
+        target_dict = target.dict()
+        target_dict.update(update_data)
+        updated_profile = Profile(**target_dict)
+        
+        # Replace in list
+        index.profiles = [updated_profile if p.id == profile_id else p for p in index.profiles]
     
     return {"success": True, "profile": updated_profile}
 
 @app.delete("/profiles/{profile_id}")
-def delete_profile(profile_id: str):
-    index = load_index()
-    profiles_list = index.profiles
-    
-    target = None
-    for p in profiles_list:
-        if p.id == profile_id:
-            target = p
-            break
-            
-    if not target:
-        raise HTTPException(status_code=404, detail="Profile not found")
-        
-    # Delete file
-    file_path = os.path.join(PROFILES_DIR, target.file)
-    if os.path.exists(file_path):
-        os.remove(file_path)
-        
-    # Remove from list
-    index.profiles = [p for p in profiles_list if p.id != profile_id]
-    
-    if index.selected == profile_id:
-        index.selected = index.profiles[0].id if index.profiles else None
+async def delete_profile(profile_id: str):
+    async with mutate_index() as index:
+        profiles_list = index.profiles
         
-    save_index(index)
+        target = None
+        for p in profiles_list:
+            if p.id == profile_id:
+                target = p
+                break
+                
+        if not target:
+            raise HTTPException(status_code=404, detail="Profile not found")
+            
+        # Delete file
+        file_path = os.path.join(PROFILES_DIR, target.file)
+        if os.path.exists(file_path):
+            await run_blocking(os.remove, file_path)
+            
+        # Remove from list
+        index.profiles = [p for p in profiles_list if p.id != profile_id]
+        
+        if index.selected == profile_id:
+            index.selected = index.profiles[0].id if index.profiles else None
+            
     return {"success": True, "index": index}
 
-async def reload_clash_config():
+async def reload_clash_config(endpoint: Optional[ControllerEndpoint] = None):
     """Force Clash Core to reload the config file"""
     try:
-        index = load_index()
-        
-        # Default from Config
-        default_host = APP_CONFIG["clash"].get("controller_host", "127.0.0.1")
-        default_port = APP_CONFIG["ports"].get("clash_controller", 9090)
-        default_secret = APP_CONFIG["clash"].get("secret", "")
-        
-        controller = f"{default_host}:{default_port}"
-        secret = default_secret
-        
-        if index.preferences:
-            controller = index.preferences.external_controller or controller
-            secret = index.preferences.secret or secret
-        
-        # Ensure protocol
-        if not controller.startswith("http"):
-            controller = f"http://{controller}"
-            
-        url = f"{controller}/configs"
+        endpoint = endpoint or get_controller_endpoint()
+        url = f"{endpoint.http_url}/configs"
         payload = {"path": CONFIG_PATH}
-        headers = {"Authorization": f"Bearer {secret}"} if secret else {}
         
-        async with httpx.AsyncClient(timeout=5.0, trust_env=False) as client:
-            resp = await client.put(url, json=payload, headers=headers)
-            if resp.status_code == 204:
-                print("Clash Core reloaded config successfully")
-            else:
-                print(f"Clash Core reload failed: {resp.status_code} {resp.text}")
+        client = await get_controller_client(endpoint)
+        resp = await client.put(url, json=payload, headers=endpoint.auth_headers, timeout=5.0)
+        invalidate_controller_cache()
+        if resp.status_code == 204:
+            print("Clash Core reloaded config successfully")
+        else:
+            print(f"Clash Core reload failed: {resp.status_code} {resp.text}")
     except Exception as e:
         print(f"Failed to reload Clash Core: {e}")
 
+# --- Config Apply ---
+# Preferences the core picks up live through PATCH /configs, and their config key
+LIVE_PREFERENCE_FIELDS = {
+    "mixed_port": "mixed-port",
+    "allow_lan": "allow-lan",
+    "ipv6": "ipv6"
+}
+# Rewrites more of the config than PATCH can carry (tun + dns)
+RELOAD_PREFERENCE_FIELDS = {"tun_mode"}
+# A reload re-creates the controller from config.yaml (Mihomo), so these need
+# one too: it is sent to the old address and the new one is used once it answers
+CONTROLLER_PREFERENCE_FIELDS = {"external_controller", "secret"}
+# Only a new core process picks these up
+RESTART_PREFERENCE_FIELDS = {"clash_binary_path", "clash_config_dir"}
+
+def diff_preferences(old: Optional[Preferences], new: Preferences) -> List[str]:
+    old_values = old.dict() if old else {}
+    return [k for k, v in new.dict().items() if old_values.get(k) != v]
+
+async def patch_clash_config(payload: Dict[str, Any]) -> bool:
+    try:
+        endpoint = get_controller_endpoint()
+        client = await get_controller_client(endpoint)
+        resp = await client.patch(f"{endpoint.http_url}/configs", json=payload, headers=endpoint.auth_headers, timeout=5.0)
+        invalidate_controller_cache()
+        if resp.status_code == 204:
+            return True
+        print(f"Clash Core patch failed: {resp.status_code} {resp.text}")
+    except Exception as e:
+        print(f"Failed to patch Clash Core config: {e}")
+    return False
+
+async def follow_controller(timeout: float = 5) -> bool:
+    """After a reload: wait for the controller on its configured address and use it from then on"""
+    global controller_endpoint_override
+    endpoint = resolve_controller_endpoint(get_index())
+    deadline = time.monotonic() + timeout
+    while not await core_is_reachable(endpoint):
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.05)
+    if core_supervisor.is_alive():
+        core_supervisor.endpoint = endpoint
+    controller_endpoint_override = None
+    invalidate_controller_endpoint()
+    invalidate_controller_cache()
+    return True
+
+async def core_is_reachable(endpoint: Optional[ControllerEndpoint] = None, client: Optional[httpx.AsyncClient] = None) -> bool:
+    try:
+        endpoint = endpoint or get_controller_endpoint()
+        client = client or await get_controller_client(endpoint)
+        resp = await client.get(f"{endpoint.http_url}/version", headers=endpoint.auth_headers, timeout=1.0)
+        return resp.status_code == 200
+    except Exception:
+        return False
+
+async def apply_config_changes(prefs: Preferences, changed: List[str], config_changed: bool, profile_changed: bool, reason: str,
+                               previous_endpoint: Optional[ControllerEndpoint] = None) -> Dict[str, Any]:
+    """
+    Pick the cheapest way to bring the core in line with config.yaml: nothing,
+    PATCH /configs for live fields, a full reload, or a process (re)start.
+    previous_endpoint is where the controller listened before these changes.
+    """
+    live = [k for k in changed if k in LIVE_PREFERENCE_FIELDS]
+    needs_restart = any(k in RESTART_PREFERENCE_FIELDS for k in changed)
+    controller_moved = any(k in CONTROLLER_PREFERENCE_FIELDS for k in changed)
+    if controller_moved:
+        # A swap drain moves the controller itself when it ends, let it finish first
+        await core_supervisor.settle()
+
+    # The core keeps its old controller until it reloads config.yaml
+    reachable_at = None
+    for endpoint in [get_controller_endpoint()] + ([previous_endpoint] if controller_moved and previous_endpoint else []):
+        if await core_is_reachable(endpoint):
+            reachable_at = endpoint
+            break
+
+    if "system_proxy" in changed:
+        action = "start" if prefs.system_proxy else "stop"
+    elif needs_restart and core_supervisor.is_alive():
+        # Only a core we spawned can be replaced by a new process
+        action = "restart"
+    elif reachable_at is not None:
+        # Also a core we don't own (systemd unit from /auto_start, started by hand)
+        if config_changed and (profile_changed or controller_moved or any(k in RELOAD_PREFERENCE_FIELDS for k in changed)):
+            action = "reload"
+        elif config_changed and live:
+            action = "patch"
+        else:
+            action = "none"
+    elif core_supervisor.is_alive():
+        # Our core is up but its controller doesn't answer
+        action = "restart"
+    elif prefs.system_proxy:
+        action = "start"
+    else:
+        # Nothing running, the core reads config.yaml when it starts
+        action = "none"
+
+    decision = {"action": action, "reason": reason, "changed": changed, "config_changed": config_changed}
+    if action == "patch":
+        decision["patch"] = {LIVE_PREFERENCE_FIELDS[k]: getattr(prefs, k) for k in live}
+    logger.info(f"Config apply ({reason}): {action} - changed={changed}, config_changed={config_changed}, profile_changed={profile_changed}")
+
+    if action == "restart" and APP_CONFIG.get("advanced", {}).get("core_swap_mode", "blue_green") == "blue_green" \
+            and await core_supervisor.swap():
+        # New core took over without dropping connections
+        decision["action"] = "swap"
+        decision["ready_ms"] = core_supervisor.ready_ms
+        logger.info(f"Config apply ({reason}): blue/green swap done in {core_supervisor.ready_ms}ms")
+    elif action in ("start", "restart"):
+        await set_system_proxy(True, prefs.mixed_port)
+        decision["ready_ms"] = core_supervisor.ready_ms
+    elif action == "stop":
+        await set_system_proxy(False, prefs.mixed_port)
+    elif action == "reload":
+        await reload_clash_config(reachable_at)
+        if controller_moved and not await follow_controller():
+            logger.info(f"Config apply ({reason}): controller did not come up on its new address")
+    elif action == "patch":
+        if not await patch_clash_config(decision["patch"]):
+            logger.info(f"Config apply ({reason}): patch rejected, falling back to reload")
+            decision["action"] = "reload"
+            await reload_clash_config()
+    return decision
+
 @app.put("/profiles/select/{profile_id}")
 async def select_profile(profile_id: str):
-    index = load_index()
-    try:
-        profile = next(p for p in index.profiles if p.id == profile_id)
-    except StopIteration:
+    profile = get_profile(profile_id)
+    if profile is None:
         raise HTTPException(status_code=404, detail="Profile not found")
         
     file_path = os.path.join(PROFILES_DIR, profile.file)
     if not os.path.exists(file_path):
         raise HTTPException(status_code=500, detail="Profile file missing")
 
-    # Merge logic
-    with open(file_path, "r", encoding="utf-8") as f:
-        profile_config = yaml.safe_load(f)
-    
-    # Apply Global Preferences
-    if index.preferences:
-        profile_config = inject_config_overrides(profile_config, index.preferences)
-    with open(CONFIG_PATH, "w", encoding="utf-8") as f:
-        yaml.safe_dump(profile_config, f)
-    
-    # Reload Core or Restart if needed
-    # Apply Global Preferences (Restart Core if System Proxy is enabled/toggle logic)
-    if index.preferences:
-         set_system_proxy(index.preferences.system_proxy, index.preferences.mixed_port)
-    
-    # Update selected profile in index
-    index.selected = profile_id
-    save_index(index)
-    
-    # Reload Core
-    await reload_clash_config()
+    # config.yaml and the selection are written in the same order as other index changes
+    async with mutate_index() as index:
+        # Merge logic, applying Global Preferences
+        config_changed = await run_blocking(apply_profile_config, file_path, index.preferences)
+        index.selected = profile_id
     
+    # Reload Core only if the merged config differs, start it if it is down
+    decision = await apply_config_changes(index.preferences or Preferences(), [], config_changed, profile_changed=True, reason="select")
     
-    return {"success": True}
+    return {"success": True, "apply": decision}
 
 class TestRequest(BaseModel):
     url: str
     match: str = "" # Keyword to match. If empty, just check 200 OK.
     type: str = "status" # status, text, json
+    id: Optional[str] = None # Echoed back by the batch endpoint
 
-@app.post("/test/unlock")
-async def test_unlock(req: TestRequest):
-    index = load_index()
+class UnlockBatchRequest(BaseModel):
+    tests: List[TestRequest]
+    concurrency: Optional[int] = None # defaults to advanced.unlock_test_concurrency
+
+UNLOCK_TEST_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+}
+
+def make_unlock_client(max_connections: int = 10) -> httpx.AsyncClient:
+    """Client going out through the Clash mixed port"""
+    index = get_index()
     proxy_port = index.preferences.mixed_port if index.preferences else 7890
     proxy_url = f"http://127.0.0.1:{proxy_port}"
     
     timeout_s = APP_CONFIG.get("advanced", {}).get("delay_test_timeout", 5000) / 1000.0
+    return httpx.AsyncClient(
+        proxy=proxy_url,
+        verify=False,
+        timeout=timeout_s,
+        follow_redirects=True,
+        headers=UNLOCK_TEST_HEADERS,
+        limits=httpx.Limits(max_connections=max_connections)
+    )
+
+async def run_unlock_test(client: httpx.AsyncClient, req: TestRequest, node: Optional[str] = None) -> Dict[str, Any]:
+    # Matrix runs keep a latency history per service and node
+    latency_key = f"{UNLOCK_LATENCY_PREFIX}{urllib.parse.urlparse(req.url).netloc}" + (f"@{node}" if node else "")
     start_time = time.time()
     try:
-        async with httpx.AsyncClient(proxy=proxy_url, verify=False, timeout=timeout_s, follow_redirects=True) as client:
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-            }
-            resp = await client.get(req.url, headers=headers)
-            latency = int((time.time() - start_time) * 1000)
-            
-            is_success = False
-            info = ""
-            
-            if req.type == "status":
-                if req.match and req.match.lower() == "not available":
-                     # Negative match status (e.g. Netflix) - complex, simplfy for now
-                     # Usually 200 OK means accessible
-                     is_success = resp.status_code < 400
-                elif req.match:
-                    # Match specific status code if match is digit
-                    if req.match.isdigit():
-                         is_success = resp.status_code == int(req.match)
-                    else:
-                         is_success = resp.status_code < 400
-                else:
-                    is_success = resp.status_code < 400
-                    
-            elif req.type == "text" or req.type == "json":
-                content = resp.text
-                if req.match:
-                     if req.match.startswith("!"):
-                         # Negative match
-                         keyword = req.match[1:]
-                         is_success = keyword not in content
-                     else:
-                        is_success = req.match in content
+        resp = await client.get(req.url)
+        latency = int((time.time() - start_time) * 1000)
+        latency_store.add(latency_key, latency)
+        
+        is_success = False
+        info = ""
+        
+        if req.type == "status":
+            if req.match and req.match.lower() == "not available":
+                 # Negative match status (e.g. Netflix) - complex, simplfy for now
+                 # Usually 200 OK means accessible
+                 is_success = resp.status_code < 400
+            elif req.match:
+                # Match specific status code if match is digit
+                if req.match.isdigit():
+                     is_success = resp.status_code == int(req.match)
                 else:
-                    is_success = resp.status_code < 400
-            
-            return {
-                "status": "success" if is_success else "failed",
-                "latency": f"{latency}ms",
-                "info": "Unlocked" if is_success else "Failed"
-            }
-            
+                     is_success = resp.status_code < 400
+            else:
+                is_success = resp.status_code < 400
+                
+        elif req.type == "text" or req.type == "json":
+            content = resp.text
+            if req.match:
+                 if req.match.startswith("!"):
+                     # Negative match
+                     keyword = req.match[1:]
+                     is_success = keyword not in content
+                 else:
+                    is_success = req.match in content
+            else:
+                is_success = resp.status_code < 400
+        
+        return {
+            "status": "success" if is_success else "failed",
+            "latency": f"{latency}ms",
+            "info": "Unlocked" if is_success else "Failed"
+        }
+        
     except Exception as e:
+        if isinstance(e, (httpx.TimeoutException, httpx.ProxyError)):
+            # The core answered but the service didn't. Anything else (mixed port
+            # down, bad URL) measured nothing.
+            latency_store.add(latency_key, 0)
         return {
             "status": "failed",
             "latency": "Error",
             "info": str(e)
         }
+
+async def run_unlock_suite(client: httpx.AsyncClient, tests: List[TestRequest], concurrency: int, node: Optional[str] = None):
+    """Run unlock tests concurrently on one client, yielding (index, result) as they finish"""
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def run(i: int, test: TestRequest):
+        async with semaphore:
+            return i, await run_unlock_test(client, test, node)
+
+    tasks = [asyncio.create_task(run(i, test)) for i, test in enumerate(tests)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def sse_message(data: Any, event: Optional[str] = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/test/unlock")
+async def test_unlock(req: TestRequest):
+    async with make_unlock_client() as client:
+        return await run_unlock_test(client, req)
+
+@app.post("/test/unlock/batch")
+async def test_unlock_batch(req: UnlockBatchRequest):
+    """
+    Run a whole unlock suite concurrently over one pooled proxied client.
+    Per-target results are streamed as Server-Sent Events as they finish.
+    """
+    concurrency = req.concurrency or APP_CONFIG.get("advanced", {}).get("unlock_test_concurrency", 8)
+
+    async def events():
+        async with make_unlock_client(max_connections=concurrency) as client:
+            async for i, result in run_unlock_suite(client, req.tests, concurrency):
+                yield sse_message({"index": i, "id": req.tests[i].id, "url": req.tests[i].url, **result})
+        yield sse_message({}, event="done")
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+# --- Latency History ---
+class LatencyRing:
+    """Fixed-size ring of (timestamp, latency ms) samples, 0 ms marks a failed test"""
+    __slots__ = ("timestamps", "latencies", "pos", "count")
+
+    def __init__(self, capacity: int):
+        self.timestamps = array("d", bytes(8 * capacity))
+        self.latencies = array("I", bytes(4 * capacity))
+        self.pos = 0
+        self.count = 0
+
+    def add(self, timestamp: float, latency: int):
+        self.timestamps[self.pos] = timestamp
+        self.latencies[self.pos] = latency
+        self.pos = (self.pos + 1) % len(self.timestamps)
+        self.count = min(self.count + 1, len(self.timestamps))
+
+    def samples(self, since: float = 0):
+        """(timestamp, latency) pairs newer than since, oldest first"""
+        size = len(self.timestamps)
+        start = (self.pos - self.count) % size
+        for i in range(self.count):
+            idx = (start + i) % size
+            if self.timestamps[idx] >= since:
+                yield self.timestamps[idx], self.latencies[idx]
+
+class LatencyStore:
+    """
+    Delay measurements per node, kept in bounded rings and persisted to an
+    append-only binary log under CONFIG_DIR. The log is compacted from the
+    rings once it grows past max_log_bytes.
+    """
+    record = struct.Struct("<dIH")  # timestamp, latency ms, name length (utf-8 name follows)
+
+    def __init__(self, path: str, capacity: int = 128, max_log_bytes: int = 8 * 1024 * 1024):
+        self.path = path
+        self.capacity = capacity
+        self.max_log_bytes = max_log_bytes
+        self.rings: Dict[str, LatencyRing] = {}
+        self.pending = bytearray()
+
+    def add(self, name: str, latency: Optional[int], timestamp: Optional[float] = None, persist: bool = True):
+        timestamp = timestamp or time.time()
+        latency = int(latency or 0)
+        ring = self.rings.get(name)
+        if ring is None:
+            ring = self.rings[name] = LatencyRing(self.capacity)
+        ring.add(timestamp, latency)
+        if persist:
+            encoded = name.encode("utf-8")[:0xFFFF]
+            self.pending += self.record.pack(timestamp, latency, len(encoded)) + encoded
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+            offset = 0
+            while offset + self.record.size <= len(data):
+                timestamp, latency, name_len = self.record.unpack_from(data, offset)
+                offset += self.record.size
+                if offset + name_len > len(data):
+                    break  # Truncated tail record
+                name = data[offset:offset + name_len].decode("utf-8", "replace")
+                offset += name_len
+                self.add(name, latency, timestamp, persist=False)
+            print(f"Loaded latency history for {len(self.rings)} nodes")
+        except Exception as e:
+            print(f"Failed to load latency history: {e}")
+
+    def take_pending(self) -> bytes:
+        data, self.pending = bytes(self.pending), bytearray()
+        return data
+
+    def append_log(self, data: bytes) -> bool:
+        """Append records to the log, True once it is due for compaction"""
+        if data:
+            with open(self.path, "ab") as f:
+                f.write(data)
+        try:
+            return os.path.getsize(self.path) > self.max_log_bytes
+        except OSError:
+            return False
+
+    def snapshot(self) -> bytes:
+        """Log content rebuilt from the rings. Everything pending is in there too."""
+        out = bytearray()
+        for name, ring in self.rings.items():
+            encoded = name.encode("utf-8")[:0xFFFF]
+            for timestamp, latency in ring.samples():
+                out += self.record.pack(timestamp, latency, len(encoded)) + encoded
+        self.pending = bytearray()
+        return bytes(out)
+
+    def flush(self):
+        if self.append_log(self.take_pending()):
+            durable_write(self.path, self.snapshot())
+
+    async def flush_async(self):
+        """flush() with the file writes on the I/O pool, the rings are only read on the loop"""
+        if await run_blocking(self.append_log, self.take_pending()):
+            await run_blocking(durable_write, self.path, self.snapshot())
+
+    def stats(self, name: str, window: float) -> Dict[str, Any]:
+        samples = list(self.rings[name].samples(time.time() - window)) if name in self.rings else []
+        ok = [(ts, latency) for ts, latency in samples if latency > 0]
+        result = {
+            "name": name,
+            "count": len(samples),
+            "loss": round(1 - len(ok) / len(samples), 4) if samples else None,
+            "p50": None, "p90": None, "p99": None,
+            "last": (samples[-1][1] or None) if samples else None,
+            "trend": None
+        }
+        if ok:
+            latencies = sorted(latency for _, latency in ok)
+            for p in (50, 90, 99):
+                # Nearest-rank percentile
+                result[f"p{p}"] = latencies[max(0, math.ceil(p / 100 * len(latencies)) - 1)]
+        if len(ok) >= 3 and ok[-1][0] - ok[0][0] >= 60:
+            # Least-squares slope in ms per hour, positive means getting slower
+            mean_t = sum(ts for ts, _ in ok) / len(ok)
+            mean_l = sum(latency for _, latency in ok) / len(ok)
+            var_t = sum((ts - mean_t) ** 2 for ts, _ in ok)
+            if var_t > 0:
+                slope = sum((ts - mean_t) * (latency - mean_l) for ts, latency in ok) / var_t
+                result["trend"] = round(slope * 3600, 2)
+        return result
+
+latency_store = LatencyStore(
+    os.path.join(CONFIG_DIR, "latency.log"),
+    capacity=APP_CONFIG.get("advanced", {}).get("latency_history_size", 128)
+)
+
+# Controller answers that mean the node was tested and failed (timeout / unreachable).
+# Other errors (404 unknown node, 400 bad url) measured nothing and are not recorded.
+DELAY_FAILURE_STATUSES = {408, 503, 504}
+
+# Unlock test histories share the store, under their own prefix
+UNLOCK_LATENCY_PREFIX = "unlock:"
+
+def record_delay_result(name: str, status_code: int, data: Dict[str, Any]):
+    if status_code == 200:
+        latency_store.add(name, data.get("delay"))
+    elif status_code in DELAY_FAILURE_STATUSES:
+        latency_store.add(name, None)
+
+async def flush_latency_store(interval: float = 5.0):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await latency_store.flush_async()
+        except Exception as e:
+            print(f"Failed to flush latency history: {e}")
+
+@app.get("/latency")
+async def get_latency_stats(window: int = 3600, names: Optional[str] = None, sort: str = "p90", unlock: bool = False):
+    """
+    Latency summary per node over the last `window` seconds: p50/p90/p99,
+    loss rate and trend (ms/hour). `names` is a comma separated filter, nodes
+    are ordered by `sort` (p50/p90/p99/loss) with untested nodes last.
+    Unlock test histories (unlock:<host>[@node]) are only listed with `unlock`.
+    """
+    if names:
+        selected = [n for n in names.split(",") if n]
+    else:
+        selected = [n for n in list(latency_store.rings) if unlock or not n.startswith(UNLOCK_LATENCY_PREFIX)]
+    nodes = [latency_store.stats(name, window) for name in selected]
+    if sort in ("p50", "p90", "p99", "loss"):
+        nodes.sort(key=lambda n: (n[sort] is None, n[sort] if n[sort] is not None else 0))
+    return {"window": window, "nodes": nodes}
+
+class DelayTestRequest(BaseModel):
+    group: Optional[str] = None # Test every node of this group
+    proxies: Optional[List[str]] = None # Or an explicit list of nodes
+    url: str = "http://www.gstatic.com/generate_204"
+    timeout: Optional[int] = None # ms, defaults to advanced.delay_test_timeout
+    concurrency: Optional[int] = None # defaults to advanced.delay_test_concurrency
+
+async def run_delay_tests(names: List[str], url: str, timeout_ms: int, concurrency: int):
+    """Delay-test nodes through the controller, yielding results as they complete"""
+    endpoint = get_controller_endpoint()
+    client = await get_controller_client(endpoint)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def test(name: str) -> Dict[str, Any]:
+        async with semaphore:
+            try:
+                resp = await client.get(
+                    f"{endpoint.http_url}/proxies/{urllib.parse.quote(name, safe='')}/delay",
+                    params={"url": url, "timeout": timeout_ms},
+                    headers=endpoint.auth_headers,
+                    timeout=timeout_ms / 1000.0 + 5
+                )
+                data = resp.json()
+                delay = data.get("delay") if resp.status_code == 200 else None
+                record_delay_result(name, resp.status_code, data)
+                if delay:
+                    return {"name": name, "delay": delay}
+                return {"name": name, "delay": None, "error": data.get("message", f"HTTP {resp.status_code}")}
+            except Exception as e:
+                # Controller unreachable or garbled answer, the node was not measured
+                return {"name": name, "delay": None, "error": str(e) or type(e).__name__}
+
+    tasks = [asyncio.create_task(test(name)) for name in names]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # Client went away before the batch finished
+        for task in tasks:
+            task.cancel()
+        # Node histories changed
+        invalidate_controller_cache()
+
+async def fetch_proxy_group(group: str) -> Dict[str, Any]:
+    endpoint = get_controller_endpoint()
+    client = await get_controller_client(endpoint)
+    resp = await client.get(
+        f"{endpoint.http_url}/proxies/{urllib.parse.quote(group, safe='')}",
+        headers=endpoint.auth_headers
+    )
+    if resp.status_code != 200:
+        raise HTTPException(status_code=404, detail=f"Proxy group not found: {group}")
+    return resp.json()
+
+async def resolve_group_nodes(group: str) -> List[str]:
+    group_info = await fetch_proxy_group(group)
+    return [name for name in group_info.get("all", []) if name not in ("DIRECT", "REJECT")]
+
+async def select_group_proxy(group: str, name: str):
+    endpoint = get_controller_endpoint()
+    client = await get_controller_client(endpoint)
+    resp = await client.put(
+        f"{endpoint.http_url}/proxies/{urllib.parse.quote(group, safe='')}",
+        json={"name": name},
+        headers=endpoint.auth_headers
+    )
+    resp.raise_for_status()
+    invalidate_controller_cache()
+
+@app.post("/delay_test")
+async def batch_delay_test(req: DelayTestRequest):
+    """
+    Batch delay test for a whole group (or node list), run by the backend with
+    the configured concurrency/timeout. Results are streamed as Server-Sent Events.
+    """
+    advanced = APP_CONFIG.get("advanced", {})
+    timeout_ms = req.timeout or advanced.get("delay_test_timeout", 2500)
+    concurrency = req.concurrency or advanced.get("delay_test_concurrency", 15)
+
+    names = list(req.proxies or [])
+    if req.group:
+        names += await resolve_group_nodes(req.group)
+    names = list(dict.fromkeys(names))
+
+    async def events():
+        async for result in run_delay_tests(names, req.url, timeout_ms, concurrency):
+            yield sse_message(result)
+        yield sse_message({}, event="done")
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+# --- Unlock Matrix ---
+
+UNLOCK_MATRIX_FILE = os.path.join(CONFIG_DIR, "unlock_matrix.json")
+
+class UnlockMatrixRequest(BaseModel):
+    group: str # Selector group the tested services are routed through
+    tests: List[TestRequest]
+    nodes: Optional[List[str]] = None # Subset of the group, defaults to every node
+    concurrency: Optional[int] = None
+    force: bool = False # Ignore cached results
+
+class UnlockMatrixJob:
+    """
+    Walks a selector group node by node: switch the group through the controller,
+    run the unlock suite over the mixed port and store one row of the node x service
+    matrix. The selection is global so nodes are visited one at a time, the tests for
+    a node run concurrently.
+
+    Rows are persisted with timestamps, results younger than the TTL are reused, so
+    starting the same job again after a cancel or restart resumes where it stopped.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.results: Dict[str, Dict[str, Dict[str, Any]]] = {} # node -> test -> result
+        self.task: Optional[asyncio.Task] = None
+        self.state = "idle" # idle, running, done, cancelled, failed, interrupted
+        self.group: Optional[str] = None
+        self.original: Optional[str] = None
+        self.nodes: List[str] = []
+        self.done = 0
+        self.current: Optional[str] = None
+        self.error: Optional[str] = None
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.save_lock = asyncio.Lock() # Saves land in call order
+
+    @staticmethod
+    def test_key(test: TestRequest) -> str:
+        return test.id or test.url
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"Failed to load unlock matrix: {e}")
+            return
+        self.results = data.get("results", {})
+        self.group = data.get("group")
+        self.original = data.get("original")
+        self.state = data.get("state", "idle")
+        if self.state == "running":
+            # Backend stopped mid-run, the group may still point at a test node
+            self.state = "interrupted"
+
+    async def restore_interrupted(self, timeout: float = 120):
+        """Put the group of a run cut short by a backend stop back on its original node"""
+        if self.state != "interrupted" or not self.group or not self.original:
+            return
+        # The core may still be starting (auto_set_proxy) or come up later
+        deadline = time.monotonic() + timeout
+        while not await core_is_reachable():
+            if time.monotonic() > deadline:
+                print(f"Core not reachable, {self.group} left on its last test node")
+                return
+            await asyncio.sleep(1)
+        if self.state != "interrupted" or (self.task and not self.task.done()):
+            # A new run took over the group meanwhile
+            return
+        try:
+            await select_group_proxy(self.group, self.original)
+        except Exception as e:
+            print(f"Failed to restore {self.group} -> {self.original}: {e}")
+            return
+        print(f"Unlock matrix: restored {self.group} -> {self.original} after interrupted run")
+        self.state = "cancelled"
+        await self.save()
+
+    async def save(self):
+        data = {
+            "group": self.group,
+            "original": self.original,
+            "state": self.state,
+            "results": self.results
+        }
+        # Serialized here, the rows are only touched on the loop. The fsyncs run on the I/O pool.
+        payload = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        try:
+            async with self.save_lock:
+                await run_blocking(durable_write, self.path, payload)
+        except Exception as e:
+            print(f"Failed to save unlock matrix: {e}")
+
+    def is_cached(self, node: str, test: TestRequest, ttl: float) -> bool:
+        result = self.results.get(node, {}).get(self.test_key(test))
+        return bool(result) and time.time() - result.get("time", 0) < ttl
+
+    async def start(self, req: UnlockMatrixRequest):
+        if self.task and not self.task.done():
+            raise HTTPException(status_code=409, detail="Unlock matrix job already running")
+
+        group_info = await fetch_proxy_group(req.group)
+        nodes = [name for name in group_info.get("all", []) if name not in ("DIRECT", "REJECT")]
+        if req.nodes:
+            wanted = set(req.nodes)
+            nodes = [name for name in nodes if name in wanted]
+
+        # Resuming an interrupted run: the current selection is one of ours
+        if not (self.state == "interrupted" and self.group == req.group and self.original):
+            self.original = group_info.get("now")
+        self.group = req.group
+        self.nodes = nodes
+        self.done = 0
+        self.error = None
+        self.started = time.time()
+        self.finished = None
+        self.state = "running"
+        await self.save()
+
+        advanced = APP_CONFIG.get("advanced", {})
+        concurrency = req.concurrency or advanced.get("unlock_test_concurrency", 8)
+        ttl = 0 if req.force else advanced.get("unlock_matrix_cache_ttl", 21600)
+        self.task = asyncio.create_task(self.run(req.tests, concurrency, ttl))
+
+    async def cancel(self):
+        if self.task and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def run(self, tests: List[TestRequest], concurrency: int, ttl: float):
+        switched = False
+        try:
+            for node in self.nodes:
+                pending = [test for test in tests if not self.is_cached(node, test, ttl)]
+                if pending:
+                    self.current = node
+                    row = self.results.setdefault(node, {})
+                    switched = True
+                    await select_group_proxy(self.group, node)
+                    # Fresh client per node, pooled connections would stay on the previous node
+                    async with make_unlock_client(max_connections=concurrency) as client:
+                        async for i, result in run_unlock_suite(client, pending, concurrency, node):
+                            row[self.test_key(pending[i])] = {**result, "time": time.time()}
+                    await self.save()
+                self.done += 1
+            self.state = "done"
+        except asyncio.CancelledError:
+            self.state = "cancelled"
+            raise
+        except Exception as e:
+            print(f"Unlock matrix job failed: {e}")
+            self.state = "failed"
+            self.error = str(e) or type(e).__name__
+        finally:
+            self.current = None
+            self.finished = time.time()
+            if switched and self.original:
+                try:
+                    await select_group_proxy(self.group, self.original)
+                except Exception as e:
+                    print(f"Failed to restore {self.group} -> {self.original}: {e}")
+            await self.save()
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "group": self.group,
+            "original": self.original,
+            "current": self.current,
+            "done": self.done,
+            "total": len(self.nodes),
+            "error": self.error,
+            "started": self.started,
+            "finished": self.finished,
+            "matrix": {node: self.results.get(node, {}) for node in self.nodes} if self.nodes else self.results
+        }
+
+unlock_matrix = UnlockMatrixJob(UNLOCK_MATRIX_FILE)
+
+@app.post("/test/unlock/matrix")
+async def start_unlock_matrix(req: UnlockMatrixRequest):
+    await unlock_matrix.start(req)
+    return unlock_matrix.status()
+
+@app.get("/test/unlock/matrix")
+async def get_unlock_matrix():
+    return unlock_matrix.status()
+
+@app.delete("/test/unlock/matrix")
+async def cancel_unlock_matrix():
+    await unlock_matrix.cancel()
+    return unlock_matrix.status()
+
 class ProfileContentUpdate(BaseModel):
     content: str
 
 @app.get("/profiles/{profile_id}/content")
 async def get_profile_content(profile_id: str):
-    index = load_index()
-    profile = next((p for p in index.profiles if p.id == profile_id), None)
+    profile = get_profile(profile_id)
     if not profile:
         raise HTTPException(status_code=404, detail="Profile not found")
 
@@ -1083,34 +2898,34 @@ async def get_profile_content(profile_id: str):
          return {"content": ""}
 
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
+        content = await run_blocking(read_text_file, file_path)
         return {"content": content}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to read file: {str(e)}")
 
 @app.put("/profiles/{profile_id}/content")
 async def update_profile_content(profile_id: str, update: ProfileContentUpdate):
-    index = load_index()
-    profile = next((p for p in index.profiles if p.id == profile_id), None)
+    profile = get_profile(profile_id)
     if not profile:
         raise HTTPException(status_code=404, detail="Profile not found")
 
     file_path = os.path.join(PROFILES_DIR, profile.file)
     
     try:
-        with open(file_path, 'w', encoding='utf-8') as f:
-            f.write(update.content)
+        await run_blocking(write_text_file, file_path, update.content)
         
-        # Update timestamp
-        profile.updated = time.time() * 1000
-        for i, p in enumerate(index.profiles):
-            if p.id == profile_id:
-                index.profiles[i] = profile
-                break
-        save_index(index)
+        async with mutate_index() as index:
+            profile = next((p for p in index.profiles if p.id == profile_id), None)
+            if not profile:
+                raise HTTPException(status_code=404, detail="Profile not found")
+            # Update timestamp
+            profile.updated = time.time() * 1000
+            # Local edits no longer match upstream, next refresh must fetch the full body
+            profile.etag = profile.last_modified = profile.content_hash = ""
         
         return {"status": "success"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to write file: {str(e)}")
 
@@ -1118,6 +2933,13 @@ async def update_profile_content(profile_id: str, update: ProfileContentUpdate):
 async def startup_event():
     # Start auto-update scheduler
     asyncio.create_task(schedule_profile_updates())
+    asyncio.create_task(watch_index_file())
+    metrics_sampler.start()
+    loop_lag_probe.start()
+    latency_store.load()
+    asyncio.create_task(flush_latency_store())
+    unlock_matrix.load()
+    asyncio.create_task(unlock_matrix.restore_interrupted())
     
     index = load_index()
     if not index.profiles and os.path.exists(CONFIG_PATH):
@@ -1148,14 +2970,19 @@ async def startup_event():
     # Apply system configuration from config.yaml
     system_config = APP_CONFIG.get("system", {})
     
-    # Apply auto_set_proxy if configured
+    # Apply auto_set_proxy if configured. A core that is already answering
+    # (e.g. the clash.service unit from /auto_start) is left alone, taking it
+    # over would fight its Restart=always for the ports.
     if system_config.get("auto_set_proxy") and index.preferences:
-        try:
-            proxy_port = index.preferences.mixed_port or APP_CONFIG["ports"].get("clash_mixed", 7890)
-            set_system_proxy(True, proxy_port)
-            logger.info(f"系统代理已自动启用 (端口: {proxy_port})")
-        except Exception as e:
-            logger.error(f"自动启用系统代理失败: {e}")
+        if await core_is_reachable():
+            logger.info("Clash 核心已在运行, 跳过自动启动")
+        else:
+            try:
+                proxy_port = index.preferences.mixed_port or APP_CONFIG["ports"].get("clash_mixed", 7890)
+                await set_system_proxy(True, proxy_port)
+                logger.info(f"系统代理已自动启用 (端口: {proxy_port})")
+            except Exception as e:
+                logger.error(f"自动启用系统代理失败: {e}")
     
     # Log configuration info
     advanced_config = APP_CONFIG.get("advanced", {})
@@ -1163,22 +2990,218 @@ async def startup_event():
     logger.info(f"高级配置 - 订阅更新间隔: {advanced_config.get('subscription_update_interval', 24)} 小时")
 
 
-@app.websocket("/memory")
-async def websocket_memory(websocket: WebSocket):
+# --- Metrics ---
+class ProjectProcessTracker:
+    """
+    Finds the Clash core, the newest backend and the Vite dev server once and
+    keeps their psutil.Process handles. A full process scan only happens when
+    a tracked process died or after rescan_interval seconds.
+    """
+
+    def __init__(self, rescan_interval: float = 60):
+        self.rescan_interval = rescan_interval
+        self.processes: List[psutil.Process] = []
+        self.last_scan = 0.0
+
+    def scan(self):
+        processes = []
+        backend_procs = []  # 收集所有后端进程
+
+        for proc in psutil.process_iter(['pid', 'name', 'cmdline', 'create_time']):
+            try:
+                name = proc.info['name'] or ''
+                cmdline = ' '.join(proc.info['cmdline'] or [])
+                
+                # 1. Clash core process (exact match, must be the clash binary)
+                if name == 'clash':
+                    if '-d' in cmdline and '.config/clash' in cmdline:
+                        processes.append(proc)
+                
+                # 2. Backend process (collect all, will select newest later)
+                elif name == 'python' or name.startswith('python'):
+                    if 'apps/server/main.py' in cmdline and 'python -c' not in cmdline:
+                        backend_procs.append((proc.info['create_time'], proc))
+                
+                # 3. Frontend process (Vite dev server)
+                elif name == 'node':
+                    if 'vite' in cmdline.lower() or '/vite' in cmdline:
+                        processes.append(proc)
+                    
+            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+                pass
+        
+        # Only count the newest backend process (if multiple exist)
+        if backend_procs:
+            backend_procs.sort(key=lambda x: x[0], reverse=True)  # Sort by create_time, newest first
+            processes.append(backend_procs[0][1])
+
+        self.processes = processes
+        self.last_scan = time.monotonic()
+
+    def measure(self) -> Optional[int]:
+        """Sum of RSS of the tracked processes, None if one of them is gone"""
+        total = 0
+        for proc in self.processes:
+            try:
+                total += proc.memory_info().rss
+            except (psutil.NoSuchProcess, psutil.ZombieProcess):
+                return None
+            except psutil.AccessDenied:
+                pass
+        return total
+
+    def project_rss(self) -> int:
+        if time.monotonic() - self.last_scan > self.rescan_interval:
+            self.scan()
+        total = self.measure()
+        if total is None:
+            # A tracked process exited (e.g. core restart), discover again
+            self.scan()
+            total = self.measure() or 0
+        return total
+
+class EventLoopLagProbe:
+    """
+    Measures how late the event loop wakes up from a short sleep. Blocking work
+    on the loop shows up here as lag, the sampler reports the peak per sample.
+    """
+
+    def __init__(self, interval: float = 0.25, history_size: int = 240):
+        self.interval = interval
+        self.history = deque(maxlen=history_size) # (time, lag ms)
+        self.peak = 0.0
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, (loop.time() - expected) * 1000)
+            self.history.append((time.time(), round(lag, 2)))
+            self.peak = max(self.peak, lag)
+
+    def take_peak(self) -> float:
+        peak, self.peak = self.peak, 0.0
+        return round(peak, 2)
+
+    def stats(self) -> Dict[str, Any]:
+        history = list(self.history)
+        lags = sorted(lag for _, lag in history)
+        result = {"interval": self.interval, "count": len(lags), "p50": None, "p99": None, "max": None, "history": history}
+        if lags:
+            for p in (50, 99):
+                # Nearest-rank percentile
+                result[f"p{p}"] = lags[max(0, math.ceil(p / 100 * len(lags)) - 1)]
+            result["max"] = lags[-1]
+        return result
+
+loop_lag_probe = EventLoopLagProbe()
+
+class MetricsSampler:
+    """
+    Single background task sampling system memory, project RSS and CPU for
+    all /memory and /api/memory clients. Recent samples are kept in a ring
+    buffer so a new dashboard starts with history instead of an empty chart.
+    """
+    queue_size = 16
+
+    def __init__(self, interval: float = 2, history_size: int = 150):
+        self.interval = interval
+        self.history = deque(maxlen=history_size)
+        self.subscribers = set()
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.subscribers.add(queue)
+        self.start()
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+
+    def collect(self) -> Dict[str, Any]:
+        mem = psutil.virtual_memory()
+        return {
+            "time": time.time(),
+            "inuse": process_tracker.project_rss(),
+            "used": mem.used,
+            "total": mem.total,
+            "cpu": psutil.cpu_percent(None),
+            "loop_lag": loop_lag_probe.take_peak()
+        }
+
+    async def run(self):
+        while True:
+            try:
+                # Process scans walk /proc, keep them off the loop
+                sample = await run_blocking(self.collect)
+                self.history.append(sample)
+                for queue in self.subscribers:
+                    if queue.full():
+                        queue.get_nowait()  # Drop oldest
+                    queue.put_nowait(sample)
+            except Exception as e:
+                print(f"Metrics sampler error: {e}")
+            await asyncio.sleep(self.interval)
+
+process_tracker = ProjectProcessTracker(
+    rescan_interval=APP_CONFIG.get("advanced", {}).get("process_rescan_interval", 60)
+)
+metrics_sampler = MetricsSampler(
+    interval=APP_CONFIG.get("advanced", {}).get("metrics_sample_interval", 2),
+    history_size=APP_CONFIG.get("advanced", {}).get("metrics_history_size", 150)
+)
+
+async def serve_metrics(websocket: WebSocket, format_sample):
+    """Stream sampler output to a client, the first message carries the recent history"""
     await websocket.accept()
+    queue = metrics_sampler.subscribe()
     try:
+        history = [format_sample(sample) for sample in metrics_sampler.history]
+        if history:
+            await websocket.send_json({**history[-1], "history": history})
         while True:
-            mem = psutil.virtual_memory()
-            # Send data in the format expected by the frontend: { inUse: number, total: number }
-            await websocket.send_json({
-                "inUse": mem.used,
-                "total": mem.total
-            })
-            await asyncio.sleep(2)
+            await websocket.send_json(format_sample(await queue.get()))
     except WebSocketDisconnect:
         pass
     except Exception as e:
         print(f"Memory WS error: {e}")
+    finally:
+        metrics_sampler.unsubscribe(queue)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    latency_store.flush()
+    # Puts the group back on its original node
+    await unlock_matrix.cancel()
+    # After the matrix restored its group, that needs the core
+    await core_supervisor.shutdown()
+    io_executor.shutdown(wait=False)
+    index_store.close()
+
+@app.get("/loop_lag")
+async def get_loop_lag():
+    return loop_lag_probe.stats()
+
+@app.websocket("/memory")
+async def websocket_memory(websocket: WebSocket):
+    # Send data in the format expected by the frontend: { inUse: number, total: number }
+    await serve_metrics(websocket, lambda sample: {
+        "inUse": sample["used"],
+        "total": sample["total"],
+        "cpu": sample["cpu"],
+        "time": sample["time"]
+    })
 
 
 # --- IP Info Proxy ---
@@ -1194,16 +3217,15 @@ async def proxy_geoip():
     
     # Determine proxy address from config
     try:
-        index = load_index()
+        index = get_index()
         port = 7890 # Default mixed port
         if index.preferences and index.preferences.mixed_port:
              port = index.preferences.mixed_port
         else:
              # Fallback to reading config.yaml if preferences not set
-             if os.path.exists(CONFIG_PATH):
-                 with open(CONFIG_PATH, 'r') as f:
-                     config = yaml.safe_load(f)
-                     port = config.get('mixed-port', config.get('port', 7890))
+             if await run_blocking(os.path.exists, CONFIG_PATH):
+                 config = await run_blocking(lambda: parse_yaml(read_text_file(CONFIG_PATH), "config.yaml"))
+                 port = config.get('mixed-port', config.get('port', 7890))
         
         proxy_url = f"http://127.0.0.1:{port}"
         proxies = {
@@ -1249,151 +3271,205 @@ app = FastAPI()
 # 3. Mount the Backend
 app.mount("/backend", backend_app)
 
-# 3.1 WebSocket Proxy Helper
+# Starlette does not run lifespan events of mounted apps, forward them explicitly
+backend_lifespan = contextlib.AsyncExitStack()
+
+@app.on_event("startup")
+async def root_startup_event():
+    await backend_lifespan.enter_async_context(backend_app.router.lifespan_context(backend_app))
+
+    # Warm up the shared controller connection pool
+    await get_controller_client(get_controller_endpoint())
+
+@app.on_event("shutdown")
+async def root_shutdown_event():
+    await backend_lifespan.aclose()
+    await close_controller_client()
+
+# 3.1 WebSocket Stream Hub
 import websockets
 from fastapi import WebSocketDisconnect
 
-async def proxy_websocket_to_clash(websocket: WebSocket, path: str):
-    await websocket.accept()
-    
-    # Determine Controller Address
-    index = load_index()
-    default_host = APP_CONFIG["clash"].get("controller_host", "127.0.0.1")
-    default_port = APP_CONFIG["ports"].get("clash_controller", 9090)
-    default_secret = APP_CONFIG["clash"].get("secret", "")
-    
-    controller_host = default_host
-    controller_port = default_port
-    secret = default_secret
-    
-    if index.preferences:
-        # Parse external controller if needed, simplified here assuming host:port
-        if index.preferences.external_controller:
+class ClashStreamHub:
+    """
+    One upstream WebSocket to the core per stream path, shared by all
+    downstream clients. Every client gets a bounded queue, a slow client
+    loses its oldest messages instead of holding up the others.
+    """
+    queue_size = 256
+
+    def __init__(self, path: str):
+        self.path = path
+        self.subscribers = set()
+        self.task: Optional[asyncio.Task] = None
+
+    def initial_messages(self) -> List[str]:
+        return []
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        for message in self.initial_messages():
+            queue.put_nowait(message)
+        self.subscribers.add(queue)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+        if not self.subscribers:
+            # Last client left, drop the upstream subscription
+            if self.task is not None:
+                self.task.cancel()
+                self.task = None
+            if stream_hubs.get(self.path) is self:
+                del stream_hubs[self.path]
+            self.on_idle()
+
+    def on_idle(self):
+        pass
+
+    def on_overflow(self, queue: asyncio.Queue):
+        # Drop oldest
+        queue.get_nowait()
+
+    def broadcast(self, message: str):
+        for queue in self.subscribers:
+            if queue.full():
+                self.on_overflow(queue)
+            queue.put_nowait(message)
+
+    def on_message(self, message: str):
+        self.broadcast(message)
+
+    async def run(self):
+        backoff = 1
+        while True:
             try:
-                if ":" in index.preferences.external_controller:
-                    host, port = index.preferences.external_controller.split(":", 1)
-                    controller_host = host
-                    controller_port = int(port)
-                else:
-                    controller_host = index.preferences.external_controller
-            except:
-                pass
-        secret = index.preferences.secret or secret
+                async with websockets.connect(get_controller_endpoint().ws_target(self.path), max_size=None) as upstream:
+                    backoff = 1
+                    async for message in upstream:
+                        self.on_message(message if isinstance(message, str) else message.decode())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"WS Stream Error ({self.path}): {e}")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30)
 
-    # Normalize secret
-    if secret is not None:
-        secret = str(secret).strip()
+stream_hubs: Dict[str, ClashStreamHub] = {}
 
-    # Build upstream WS URL
-    ws_url = f"ws://{controller_host}:{controller_port}/{path}"
-    if secret:
-        ws_url += f"?token={secret}"
-        
-    try:
-        async with websockets.connect(ws_url) as upstream_ws:
-            # Bidirectional forwarding
-            async def forward_client_to_upstream():
-                try:
-                    while True:
-                        data = await websocket.receive_text()
-                        await upstream_ws.send(data)
-                except WebSocketDisconnect:
-                    pass
-                except Exception:
-                    pass
+def get_stream_hub(path: str) -> ClashStreamHub:
+    hub = stream_hubs.get(path)
+    if hub is None:
+        hub = stream_hubs[path] = ClashStreamHub(path)
+    return hub
 
-            async def forward_upstream_to_client():
-                try:
-                    while True:
-                        data = await upstream_ws.recv()
-                        await websocket.send_text(data)
-                except Exception:
-                    pass
-            
-            # Run both tasks
-            # Since Clash WS for traffic/logs is mostly read-only (server push), 
-            # we focus on upstream -> client. 
-            # But kept structure for completeness.
-            await asyncio.gather(
-                forward_client_to_upstream(),
-                forward_upstream_to_client(),
-                return_exceptions=True
-            )
-    except Exception as e:
-        print(f"WS Proxy Error ({path}): {e}")
-        try:
-            await websocket.close(code=1011) # Internal Error
-        except:
-            pass
+async def serve_stream_hub(websocket: WebSocket, hub: ClashStreamHub):
+    await websocket.accept()
+    queue = hub.subscribe()
+
+    async def forward_hub_to_client():
+        while True:
+            await websocket.send_text(await queue.get())
+
+    async def wait_client_disconnect():
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+
+    tasks = [asyncio.create_task(forward_hub_to_client()), asyncio.create_task(wait_client_disconnect())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    except Exception:
+        pass
+    finally:
+        for task in tasks:
+            task.cancel()
+        hub.unsubscribe(queue)
 
 # 3.2 Specific WebSocket Endpoints (Override generic proxy)
 @app.websocket("/api/traffic")
 async def ws_traffic(websocket: WebSocket):
-    await proxy_websocket_to_clash(websocket, "traffic")
+    await serve_stream_hub(websocket, get_stream_hub("traffic"))
 
 @app.websocket("/api/logs")
 async def ws_logs(websocket: WebSocket, level: str = "info"):
-    # Clash logs WS is /logs?level=...
-    # We need to construct path manually query params are not passed in path arg automatically
-    path = f"logs?level={level}"
-    await proxy_websocket_to_clash(websocket, path)
+    # Clash logs WS is /logs?level=..., one hub per level
+    path = f"logs?level={urllib.parse.quote(level)}"
+    await serve_stream_hub(websocket, get_stream_hub(path))
 
 @app.websocket("/api/memory")
 async def ws_memory(websocket: WebSocket):
     # Local Memory - Get total memory of Clash + Frontend + Backend
-    await websocket.accept()
-    try:
-        while True:
-            total_project_mem = 0
-            backend_procs = []  # 收集所有后端进程
-            
-            for proc in psutil.process_iter(['pid', 'name', 'cmdline', 'create_time']):
-                try:
-                    name = proc.info['name'] or ''
-                    cmdline = ' '.join(proc.info['cmdline'] or [])
-                    
-                    # 1. Clash core process (exact match, must be the clash binary)
-                    if name == 'clash':
-                        if '-d' in cmdline and '.config/clash' in cmdline:
-                            mem_info = proc.memory_info()
-                            total_project_mem += mem_info.rss
-                    
-                    # 2. Backend process (collect all, will select newest later)
-                    elif name == 'python' or name.startswith('python'):
-                        if 'apps/server/main.py' in cmdline and 'python -c' not in cmdline:
-                            backend_procs.append((proc.info['create_time'], proc))
-                    
-                    # 3. Frontend process (Vite dev server)
-                    elif name == 'node':
-                        if 'vite' in cmdline.lower() or '/vite' in cmdline:
-                            mem_info = proc.memory_info()
-                            total_project_mem += mem_info.rss
-                        
-                except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
-                    pass
-            
-            # Only count the newest backend process (if multiple exist)
-            if backend_procs:
-                backend_procs.sort(key=lambda x: x[0], reverse=True)  # Sort by create_time, newest first
-                newest_backend = backend_procs[0][1]
-                try:
-                    mem_info = newest_backend.memory_info()
-                    total_project_mem += mem_info.rss
-                except:
-                    pass
-            
-            # Get total system memory for reference
-            sys_mem = psutil.virtual_memory()
-            
-            await websocket.send_json({
-                "inuse": total_project_mem,  # Total project memory (Clash + Frontend + Backend)
-                "total": sys_mem.total  # Total system memory
-            })
-            await asyncio.sleep(2)
-    except WebSocketDisconnect:
-        pass
-    except Exception as e:
-        print(f"Memory WS error: {e}")
+    await serve_metrics(websocket, lambda sample: {
+        "inuse": sample["inuse"],  # Total project memory (Clash + Frontend + Backend)
+        "total": sample["total"],  # Total system memory
+        "cpu": sample["cpu"],
+        "time": sample["time"]
+    })
+
+
+# 3.3 Connections Delta Stream
+class ConnectionsHub(ClashStreamHub):
+    """
+    Shared subscription to the core's /connections stream. Keeps the
+    connection table indexed by id and pushes only added / removed /
+    changed-counter deltas downstream.
+    """
+    queue_size = 64
+
+    def __init__(self):
+        super().__init__("connections")
+        self.table: Dict[str, dict] = {}
+        self.totals = {"downloadTotal": 0, "uploadTotal": 0}
+
+    def snapshot(self) -> str:
+        return json.dumps({"type": "snapshot", "connections": list(self.table.values()), **self.totals})
+
+    def initial_messages(self) -> List[str]:
+        return [self.snapshot()]
+
+    def on_idle(self):
+        self.table = {}
+
+    def on_overflow(self, queue: asyncio.Queue):
+        # Slow client missed deltas, resync it with a full snapshot
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(self.snapshot())
+
+    def on_message(self, message: str):
+        data = json.loads(message)
+        current = {c["id"]: c for c in data.get("connections") or []}
+        added = [c for cid, c in current.items() if cid not in self.table]
+        removed = [cid for cid in self.table if cid not in current]
+        changed = []
+        for cid, c in current.items():
+            old = self.table.get(cid)
+            if old is not None and (old.get("upload") != c.get("upload") or old.get("download") != c.get("download")):
+                changed.append({"id": cid, "upload": c.get("upload", 0), "download": c.get("download", 0)})
+
+        self.table = current
+        self.totals = {
+            "downloadTotal": data.get("downloadTotal", 0),
+            "uploadTotal": data.get("uploadTotal", 0)
+        }
+        if added or removed or changed:
+            self.broadcast(json.dumps({
+                "type": "delta",
+                "added": added,
+                "removed": removed,
+                "changed": changed,
+                **self.totals
+            }))
+
+connections_hub = ConnectionsHub()
+
+@app.websocket("/api/connections/delta")
+async def ws_connections_delta(websocket: WebSocket):
+    await serve_stream_hub(websocket, connections_hub)
 
 
 # 4. Implement /api Proxy (Clash External Controller)
@@ -1401,44 +3477,8 @@ async def ws_memory(websocket: WebSocket):
 async def proxy_clash_ws(websocket: WebSocket, path_name: str):
     await websocket.accept()
     
-    # Get configured controller address
-    index = load_index()
-    default_host = APP_CONFIG["clash"].get("controller_host", "127.0.0.1")
-    default_port = APP_CONFIG["ports"].get("clash_controller", 9090)
-    default_secret = APP_CONFIG["clash"].get("secret", "")
-    
-    controller = f"{default_host}:{default_port}"
-    secret = default_secret
-    
-    if index.preferences:
-        controller = index.preferences.external_controller or controller
-        secret = index.preferences.secret or secret
-        
-    # Ensure protocol (ws/wss)
-    if not controller.startswith("http"):
-        # Assuming http -> ws
-        ws_controller = f"ws://{controller}"
-    else:
-        ws_controller = controller.replace("http://", "ws://").replace("https://", "wss://")
-
-    target_url = f"{ws_controller}/{path_name}"
-    
-    # Add auth token if needed
-    if secret:
-        # Check if query params already exist
-        if "?" in target_url:
-            target_url += f"&token={secret}"
-        else:
-            target_url += f"?token={secret}"
-            
-    # Forward query params from client
-    query_params = dict(websocket.query_params)
-    for k, v in query_params.items():
-        if k != "token": # avoid duplicate token if we added it
-             if "?" in target_url:
-                target_url += f"&{k}={v}"
-             else:
-                target_url += f"?{k}={v}"
+    # Forward query params from client, the token is replaced by the configured one
+    target_url = get_controller_endpoint().ws_target(path_name, dict(websocket.query_params))
 
     print(f"[DEBUG] WS Proxying to: {target_url}")
     
@@ -1448,8 +3488,11 @@ async def proxy_clash_ws(websocket: WebSocket, path_name: str):
             async def forward_client_to_server():
                 try:
                     while True:
-                        data = await websocket.receive_bytes()
-                        await ws_server.send(data)
+                        message = await websocket.receive()
+                        if message["type"] == "websocket.disconnect":
+                            break
+                        data = message.get("text")
+                        await ws_server.send(data if data is not None else message.get("bytes"))
                 except Exception:
                     pass
 
@@ -1457,7 +3500,11 @@ async def proxy_clash_ws(websocket: WebSocket, path_name: str):
                 try:
                     while True:
                         data = await ws_server.recv()
-                        await websocket.send_bytes(data)
+                        # Keep the frame type, Clash pushes JSON as text frames
+                        if isinstance(data, str):
+                            await websocket.send_text(data)
+                        else:
+                            await websocket.send_bytes(data)
                 except Exception:
                     pass
 
@@ -1481,97 +3528,190 @@ async def proxy_clash_ws(websocket: WebSocket, path_name: str):
 # If backend doesn't have a library for WS client, we are stuck.
 # Most fastapi projects use `websockets` lib.
 pass
-@app.api_route("/api/{path_name:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"])
-async def proxy_clash_api(path_name: str, request: Request):
-    try:
-        # Get configured controller address
-        index = load_index()
-        
-        # Default from Config
-        default_host = APP_CONFIG["clash"].get("controller_host", "127.0.0.1")
-        default_port = APP_CONFIG["ports"].get("clash_controller", 9090)
-        default_secret = APP_CONFIG["clash"].get("secret", "")
+# Fix: Vite proxy error "Content-Length can't be present with Transfer-Encoding"
+# Properly filter HTTP headers for proxy response
+# Reference: RFC 7230 Section 6.1 (Connection and hop-by-hop headers)
+
+# Hop-by-hop headers that must not be forwarded by proxies
+HOP_BY_HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate',
+    'proxy-authorization', 'proxy-connection', 'te', 
+    'trailers', 'transfer-encoding', 'upgrade'
+}
+
+def filter_response_headers(upstream_headers: httpx.Headers) -> Dict[str, str]:
+    response_headers = {}
+    has_transfer_encoding = any(
+        key.lower() == 'transfer-encoding' 
+        for key in upstream_headers.keys()
+    )
+    
+    for key, value in upstream_headers.items():
+        key_lower = key.lower()
         
-        controller = f"{default_host}:{default_port}"
-        secret = default_secret
+        # Skip hop-by-hop headers
+        if key_lower in HOP_BY_HOP_HEADERS:
+            continue
         
-        if index.preferences:
-            controller = index.preferences.external_controller or controller
-            secret = index.preferences.secret or secret
+        # Skip content-length if transfer-encoding exists (mutually exclusive per RFC 7230)
+        if key_lower == 'content-length' and has_transfer_encoding:
+            continue
         
-        # Normalize secret
-        if secret is not None:
-            secret = str(secret).strip()
+        response_headers[key] = value
+    return response_headers
+
+def decoded_body_headers(headers: Dict[str, str]) -> Dict[str, str]:
+    """Headers for a body read through httpx, which already undid the upstream encoding"""
+    return {k: v for k, v in headers.items() if k.lower() not in ("content-length", "content-encoding")}
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    accepted = set()
+    for part in accept_encoding.split(","):
+        coding, _, params = part.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        # q=0 means "not acceptable"
+        if quality > 0:
+            accepted.add(coding.strip().lower())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+def build_conditional_response(request: Request, status_code: int, body: bytes, headers: Dict[str, str]) -> Response:
+    """
+    Response for a fully read controller payload: content-hash ETag with
+    If-None-Match -> 304, and gzip/brotli compression when the client accepts it.
+    """
+    headers = decoded_body_headers(headers)
+    if status_code != 200:
+        return Response(content=body, status_code=status_code, headers=headers)
+
+    etag = f'W/"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+    headers["ETag"] = etag
+    headers["Cache-Control"] = "no-cache"
+    headers["Vary"] = "Accept-Encoding"
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    min_size = APP_CONFIG.get("advanced", {}).get("controller_compress_min_size", 1024)
+    encoding = negotiate_encoding(request.headers.get("accept-encoding", "")) if len(body) >= min_size else None
+    if encoding == "br":
+        body = brotli.compress(body, quality=4)
+    elif encoding == "gzip":
+        body = gzip.compress(body, compresslevel=5)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+
+    return Response(content=body, status_code=status_code, headers=headers)
 
-        # Ensure protocol
-        if not controller.startswith("http"):
-            controller = f"http://{controller}"
-            
-        target_url = f"{controller}/{path_name}"
+@app.api_route("/api/{path_name:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"])
+async def proxy_clash_api(path_name: str, request: Request):
+    try:
+        # Get configured controller address
+        endpoint = get_controller_endpoint()
+        target_url = f"{endpoint.http_url}/{path_name}"
         
-        # Forward headers (excluding host)
-        headers = dict(request.headers)
+        # Forward headers (excluding host and hop-by-hop headers)
+        headers = {k: v for k, v in request.headers.items() if k not in HOP_BY_HOP_HEADERS}
         headers.pop("host", None)
         headers.pop("content-length", None)
-        if secret:
-            headers["Authorization"] = f"Bearer {secret}"
+        headers.update(endpoint.auth_headers)
+
+        advanced = APP_CONFIG.get("advanced", {})
+        # Large polled JSON is read fully so it can be hashed for ETag and compressed
+        conditional = request.method == "GET" and path_name in advanced.get("controller_etag_paths", [])
+        cache_ttl = advanced.get("controller_cache_ttl", {}).get(path_name) if request.method == "GET" else None
+        # Manual delay tests are read fully so the result can go into the latency history
+        delay_node = None
+        if request.method == "GET" and path_name.startswith("proxies/") and path_name.endswith("/delay"):
+            delay_node = path_name[len("proxies/"):-len("/delay")]
+        streaming = advanced.get("controller_proxy_streaming", True) and not conditional and not cache_ttl and not delay_node
+        if conditional or cache_ttl:
+            # Let httpx negotiate with upstream, the client's validators are handled here
+            headers.pop("if-none-match", None)
+            headers.pop("accept-encoding", None)
 
         print(f"[DEBUG] Proxying to: {target_url}")
-        async with httpx.AsyncClient(verify=False, timeout=10.0, trust_env=False) as client:
-            try:
+        client = await get_controller_client(endpoint)
+
+        async def send_upstream(stream: bool) -> httpx.Response:
+            if stream:
+                # Pass the request body through as it arrives, without buffering it
+                has_body = "content-length" in request.headers or "transfer-encoding" in request.headers
+                content = request.stream() if has_body else None
+            else:
                 content = await request.body()
-                proxy_req = client.build_request(
-                    request.method,
-                    target_url,
-                    headers=headers,
-                    content=content,
-                    params=request.query_params
-                )
-                proxy_res = await client.send(proxy_req)
-                
-                # Fix: Vite proxy error "Content-Length can't be present with Transfer-Encoding"
-                # Properly filter HTTP headers for proxy response
-                # Reference: RFC 7230 Section 6.1 (Connection and hop-by-hop headers)
-                
-                # Hop-by-hop headers that must not be forwarded by proxies
-                hop_by_hop_headers = {
-                    'connection', 'keep-alive', 'proxy-authenticate',
-                    'proxy-authorization', 'proxy-connection', 'te', 
-                    'trailers', 'transfer-encoding', 'upgrade'
-                }
-                
-                response_headers = {}
-                has_transfer_encoding = any(
-                    key.lower() == 'transfer-encoding' 
-                    for key in proxy_res.headers.keys()
-                )
-                
-                for key, value in proxy_res.headers.items():
-                    key_lower = key.lower()
-                    
-                    # Skip hop-by-hop headers
-                    if key_lower in hop_by_hop_headers:
-                        continue
-                    
-                    # Skip content-length if transfer-encoding exists (mutually exclusive per RFC 7230)
-                    if key_lower == 'content-length' and has_transfer_encoding:
-                        continue
-                    
-                    response_headers[key] = value
-                
-                return Response(
-                    content=proxy_res.content,
-                    status_code=proxy_res.status_code,
-                    headers=response_headers
-                )
-            except Exception as e:
-                import traceback
-                print(f"[ERROR] Proxy Connect Failed: {e}\n{traceback.format_exc()}")
-                return Response(
-                    content=json.dumps({"error": f"Clash Proxy Connection Failed: {str(e)}"}), 
-                    status_code=502,
-                    media_type="application/json"
-                )
+            proxy_req = client.build_request(
+                request.method,
+                target_url,
+                headers=headers,
+                content=content,
+                params=request.query_params
+            )
+            return await client.send(proxy_req, stream=stream)
+
+        async def fetch_buffered() -> tuple:
+            res = await send_upstream(False)
+            return res.status_code, res.content, filter_response_headers(res.headers)
+
+        try:
+            if cache_ttl:
+                cache_key = (endpoint.http_url, path_name, str(request.query_params))
+                status_code, body, response_headers = await fetch_controller_cached(cache_key, cache_ttl, fetch_buffered)
+            else:
+                proxy_res = await send_upstream(streaming)
+                if request.method not in ("GET", "HEAD", "OPTIONS"):
+                    # e.g. proxy selection or config patch, cached snapshots are stale now
+                    invalidate_controller_cache()
+        except Exception as e:
+            import traceback
+            print(f"[ERROR] Proxy Connect Failed: {e}\n{traceback.format_exc()}")
+            return Response(
+                content=json.dumps({"error": f"Clash Proxy Connection Failed: {str(e)}"}), 
+                status_code=502,
+                media_type="application/json"
+            )
+
+        if cache_ttl:
+            if conditional:
+                return build_conditional_response(request, status_code, body, response_headers)
+            return Response(content=body, status_code=status_code, headers=decoded_body_headers(response_headers))
+
+        response_headers = filter_response_headers(proxy_res.headers)
+
+        if streaming:
+            # Raw bytes are relayed as they arrive, encoding and length stay as sent by upstream
+            return StreamingResponse(
+                proxy_res.aiter_raw(),
+                status_code=proxy_res.status_code,
+                headers=response_headers,
+                background=BackgroundTask(proxy_res.aclose)
+            )
+
+        if conditional:
+            return build_conditional_response(request, proxy_res.status_code, proxy_res.content, response_headers)
+
+        if delay_node:
+            try:
+                record_delay_result(delay_node, proxy_res.status_code, proxy_res.json())
+            except Exception:
+                pass
+
+        return Response(
+            content=proxy_res.content,
+            status_code=proxy_res.status_code,
+            headers=decoded_body_headers(response_headers)
+        )
     except Exception as e:
         import traceback
         print(f"Proxy API Failed: {e}\n{traceback.format_exc()}")
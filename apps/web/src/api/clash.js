@@ -41,6 +41,13 @@ export const getLogsWebSocket = (level = 'info', token = '') => {
     return new WebSocket(url.toString());
 };
 
+// Backend-maintained connection table: first message is a snapshot, then only deltas
+export const getConnectionsDeltaWebSocket = () => {
+    const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+    const host = window.location.host;
+    return new WebSocket(`${protocol}//${host}/api/connections/delta`);
+};
+
 export const getMemoryWebSocket = (token = '') => {
     const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
     const host = window.location.host;
@@ -124,6 +131,46 @@ export const getProxyDelay = async (name, url = 'http://www.gstatic.com/generate
     return res.json();
 };
 
+// Batch delay test run by the backend, results arrive as Server-Sent Events
+// params: { group, proxies, url, timeout }
+const readEventStream = async (res, onResult) => {
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        for (const event of events) {
+            if (event.startsWith('event: done')) return;
+            const line = event.split('\n').find(l => l.startsWith('data: '));
+            if (line) onResult(JSON.parse(line.slice(6)));
+        }
+    }
+};
+
+export const streamDelayTest = async (params, onResult) => {
+    const res = await fetch(`${BACKEND_BASE}/delay_test`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(params)
+    });
+    if (!res.ok) throw new Error(`Delay test failed: ${res.status}`);
+    await readEventStream(res, onResult);
+};
+
+export const streamUnlockTests = async (tests, onResult) => {
+    const res = await fetch(`${BACKEND_BASE}/test/unlock/batch`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ tests })
+    });
+    if (!res.ok) throw new Error(`Unlock test failed: ${res.status}`);
+    await readEventStream(res, onResult);
+};
+
 export const updatePreferences = async (data) => {
     const res = await fetch(`${BACKEND_BASE}/preferences`, {
         method: 'POST',
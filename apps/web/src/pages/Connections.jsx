@@ -1,36 +1,64 @@
-import React, { useEffect, useState } from 'react';
-import { getConnections, closeConnection } from '../api/clash';
+import React, { useEffect, useRef, useState } from 'react';
+import { getConnectionsDeltaWebSocket, closeConnection } from '../api/clash';
 import { XCircle, ArrowDown, ArrowUp, Globe, Activity, Trash2, Search, Network } from 'lucide-react';
 
 const Connections = () => {
     const [connections, setConnections] = useState([]);
     const [filter, setFilter] = useState('');
 
-    const fetchData = async () => {
-        try {
-            const data = await getConnections();
-            setConnections(data.connections || []);
-        } catch (e) {
-            console.error(e);
-        }
-    };
+    const tableRef = useRef(new Map());
 
     useEffect(() => {
-        fetchData();
-        const interval = setInterval(fetchData, 1000);
-        return () => clearInterval(interval);
+        let ws;
+        let reconnectTimer;
+        let closed = false;
+
+        const connect = () => {
+            ws = getConnectionsDeltaWebSocket();
+
+            ws.onmessage = (event) => {
+                try {
+                    const data = JSON.parse(event.data);
+                    const table = tableRef.current;
+                    if (data.type === 'snapshot') {
+                        table.clear();
+                        (data.connections || []).forEach(c => table.set(c.id, c));
+                    } else {
+                        (data.added || []).forEach(c => table.set(c.id, c));
+                        (data.removed || []).forEach(id => table.delete(id));
+                        (data.changed || []).forEach(({ id, upload, download }) => {
+                            const c = table.get(id);
+                            if (c) table.set(id, { ...c, upload, download });
+                        });
+                    }
+                    setConnections(Array.from(table.values()));
+                } catch (e) {
+                    console.error(e);
+                }
+            };
+
+            ws.onclose = () => {
+                if (!closed) reconnectTimer = setTimeout(connect, 2000);
+            };
+        };
+
+        connect();
+        return () => {
+            closed = true;
+            clearTimeout(reconnectTimer);
+            ws.close();
+        };
     }, []);
 
+    // Removals arrive through the delta stream
     const handleClose = async (id) => {
         await closeConnection(id);
-        fetchData();
     };
 
     const handleCloseAll = async () => {
         for (const conn of connections) {
             await closeConnection(conn.id);
         }
-        fetchData();
     };
 
     const filtered = connections.filter(c =>
@@ -102,6 +102,7 @@ const Dashboard = () => {
     const [isNodeMenuOpen, setIsNodeMenuOpen] = useState(false);
     const [activeTab] = useState('tun');
     const [memory, setMemory] = useState(0);
+    const [memoryHistory, setMemoryHistory] = useState([]);
     const [connections, setConnections] = useState({ uploadTotal: 0, downloadTotal: 0, connections: [] });
     const [siteDelays, setSiteDelays] = useState({
         Apple: null,
@@ -153,6 +154,10 @@ const Dashboard = () => {
         wsMemory.onmessage = (e) => {
             const data = JSON.parse(e.data);
             setMemory(data.inuse || 0);
+            // The first message carries the samples the backend collected before this page opened
+            setMemoryHistory(prev => (data.history || [...prev, data])
+                .map(s => ({ time: s.time, inuse: s.inuse || 0 }))
+                .slice(-60));
         };
 
         return () => {
@@ -729,7 +734,7 @@ const Dashboard = () => {
                                 { label: '活跃连接', val: connections.connections?.length || '0', icon: RotateCw, color: 'text-green-500', bg: 'bg-green-50', border: 'border-green-100' },
                                 { label: '上传量', val: formatBytes(connections.uploadTotal || 0), icon: Upload, color: 'text-orange-500', bg: 'bg-orange-50', border: 'border-orange-100' },
                                 { label: '下载量', val: formatBytes(connections.downloadTotal || 0), icon: Cloud, color: 'text-blue-500', bg: 'bg-blue-50', border: 'border-blue-100' },
-                                { label: '内存占用', val: formatBytes(memory), icon: Cpu, color: 'text-rose-500', bg: 'bg-rose-50', border: 'border-rose-100' },
+                                { label: '内存占用', val: formatBytes(memory), icon: Cpu, color: 'text-rose-500', bg: 'bg-rose-50', border: 'border-rose-100', spark: memoryHistory, sparkColor: '#f43f5e' },
                             ].map((s, i) => (
                                 <div key={i} className={`bg-card p-4 rounded-2xl border ${s.border} flex items-center gap-4 hover:shadow-sm transition-all cursor-default group`}>
                                     <div className={`w-11 h-11 rounded-full ${s.bg} flex items-center justify-center ${s.color} transition-transform group-hover:scale-110`}>
@@ -739,6 +744,25 @@ const Dashboard = () => {
                                         <div className="text-[13px] text-text-2 font-medium">{s.label}</div>
                                         <div className="font-bold text-text text-lg tracking-tight">{s.val}</div>
                                     </div>
+                                    {s.spark && s.spark.length > 1 && (
+                                        <div className="ml-auto w-20 h-10">
+                                            <ResponsiveContainer width="100%" height="100%">
+                                                <AreaChart data={s.spark}>
+                                                    <YAxis hide domain={['dataMin', 'dataMax']} />
+                                                    <Area
+                                                        type="monotone"
+                                                        dataKey="inuse"
+                                                        stroke={s.sparkColor}
+                                                        fill={s.sparkColor}
+                                                        fillOpacity={0.1}
+                                                        strokeWidth={1.5}
+                                                        dot={false}
+                                                        isAnimationActive={false}
+                                                    />
+                                                </AreaChart>
+                                            </ResponsiveContainer>
+                                        </div>
+                                    )}
                                 </div>
                             ))}
                         </div>
@@ -1,7 +1,7 @@
 import React, { useState, useEffect, useRef } from 'react';
 import { useNavigate } from 'react-router-dom';
 import { useSettings } from '../contexts/SettingsContext';
-import { getProxies, setProxy, updateConfig, getConfigs, getProxyDelay } from '../api/clash';
+import { getProxies, setProxy, updateConfig, getConfigs, getProxyDelay, streamDelayTest } from '../api/clash';
 import ProxyGroup from '../components/Proxies/ProxyGroup';
 import { Layers, Globe, Zap, Link } from 'lucide-react';
 import './Proxies.css';
@@ -40,78 +40,35 @@ const Proxies = () => {
         const group = groups.find(g => g.name === groupName);
         if (!group) return;
 
-        // Simple concurrency limiter
-        const limit = (concurrency) => {
-            const queue = [];
-            let active = 0;
-            const next = () => {
-                active--;
-                if (queue.length > 0) queue.shift()();
-            };
-            return (fn) => new Promise((resolve, reject) => {
-                const run = async () => {
-                    active++;
-                    try { resolve(await fn()); } catch (e) { reject(e); } finally { next(); }
-                };
-                if (active < concurrency) run();
-                else queue.push(run);
-            });
-        };
-
-        const runTask = limit(15); // Run 15 at a time
-
-        await Promise.all(group.nodes.map(node => runTask(async () => {
-            try {
-                if (node.name === 'REJECT' || node.name === 'DIRECT') return;
-
-                // Set testing state UI
-                setGroups(prev => prev.map(g => {
-                    if (g.name === groupName) {
-                        return {
-                            ...g,
-                            nodes: g.nodes.map(n => {
-                                if (n.name === node.name) return { ...n, testing: true };
-                                return n;
-                            })
-                        };
-                    }
-                    return g;
-                }));
+        const testable = new Set(group.nodes.map(n => n.name).filter(name => name !== 'REJECT' && name !== 'DIRECT'));
 
-                const res = await getProxyDelay(node.name, 'http://www.gstatic.com/generate_204', 2500);
-                const delay = res.delay;
+        const updateNodes = (update) => setGroups(prev => prev.map(g => {
+            if (g.name === groupName) {
+                return { ...g, nodes: g.nodes.map(update) };
+            }
+            return g;
+        }));
 
-                if (typeof delay !== 'number') throw new Error("Invalid delay");
+        // Set testing state UI
+        updateNodes(n => testable.has(n.name) ? { ...n, testing: true } : n);
 
-                // Update Success
-                setGroups(prev => prev.map(g => {
-                    if (g.name === groupName) {
-                        return {
-                            ...g,
-                            nodes: g.nodes.map(n => {
-                                if (n.name === node.name) return { ...n, latency: delay, testing: false };
-                                return n;
-                            })
-                        };
-                    }
-                    return g;
-                }));
-            } catch (e) {
-                // Update Timeout/Error
-                setGroups(prev => prev.map(g => {
-                    if (g.name === groupName) {
-                        return {
-                            ...g,
-                            nodes: g.nodes.map(n => {
-                                if (n.name === node.name) return { ...n, latency: null, testing: false };
-                                return n;
-                            })
-                        };
-                    }
-                    return g;
-                }));
+        // Backend tests the whole group with its own concurrency/timeout settings
+        const pending = new Set(testable);
+        try {
+            await streamDelayTest({ group: groupName }, ({ name, delay }) => {
+                pending.delete(name);
+                updateNodes(n => n.name === name
+                    ? { ...n, latency: typeof delay === 'number' ? delay : null, testing: false }
+                    : n);
+            });
+        } catch (e) {
+            console.error(e);
+        } finally {
+            // Clear anything the stream did not report (e.g. aborted)
+            if (pending.size > 0) {
+                updateNodes(n => pending.has(n.name) ? { ...n, latency: null, testing: false } : n);
             }
-        })));
+        }
     };
 
     const testNodeLatency = async (groupName, nodeName) => {
@@ -1,6 +1,7 @@
 import React, { useState, useEffect } from 'react';
 import { Play, RefreshCw, Globe, CheckCircle2, XCircle, AlertCircle, Loader2, Plus, Trash2, PlayCircle } from 'lucide-react';
 import { useSettings } from '../contexts/SettingsContext';
+import { streamUnlockTests } from '../api/clash';
 
 const DEFAULT_SERVICES = [
     {
@@ -186,8 +187,33 @@ const Test = () => {
 
     const allServices = [...DEFAULT_SERVICES, ...customServices];
 
-    const runAll = () => {
-        allServices.forEach(s => runTest(s));
+    const runAll = async () => {
+        const pending = new Set(allServices.map(s => s.id));
+        setTesting(prev => ({ ...prev, ...Object.fromEntries([...pending].map(id => [id, true])) }));
+
+        const setResult = (id, result) => {
+            pending.delete(id);
+            setResults(prev => ({
+                ...prev,
+                [id]: {
+                    ...result,
+                    updated: new Date().toLocaleString()
+                }
+            }));
+            setTesting(prev => ({ ...prev, [id]: false }));
+        };
+
+        try {
+            await streamUnlockTests(
+                allServices.map(s => ({ id: s.id, url: s.url, match: s.match, type: s.type })),
+                ({ id, status, latency, info }) => setResult(id, { status, latency, info })
+            );
+        } catch (error) {
+            console.error(error);
+        } finally {
+            // Anything the stream never reported counts as a network error
+            pending.forEach(id => setResult(id, { status: 'failed', latency: 'Error', info: 'Network Error' }));
+        }
     };
 
     return (
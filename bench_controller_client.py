@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the /api proxy: requests per second and backend CPU per request
+for GET /api/version against a local stub controller.
+
+Runs proxy_clash_api in-process, so only the backend's own work is measured.
+Run it on two checkouts to compare them.
+"""
+import asyncio
+import contextlib
+import logging
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import time
+
+# Add parent directory to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'apps', 'server'))
+
+STUB_BODY = b'{"version":"bench","premium":true}'
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def run_stub_controller(port: int):
+    """Minimal keep-alive HTTP/1.1 controller answering every GET with STUB_BODY"""
+    async def handle(reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                if not head:
+                    break
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    b"Content-Length: " + str(len(STUB_BODY)).encode() + b"\r\n\r\n" + STUB_BODY
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve():
+        server = await asyncio.start_server(handle, "127.0.0.1", port)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+def start_stub_controller() -> tuple:
+    """Stub controller in its own process so it doesn't share the backend's CPU time"""
+    port = free_port()
+    process = multiprocessing.Process(target=run_stub_controller, args=(port,), daemon=True)
+    process.start()
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return process, port
+
+def prepare_environment(port: int) -> str:
+    """Point the backend at the stub and a throwaway config dir, before main is imported"""
+    config_dir = tempfile.mkdtemp(prefix="clashwebui-bench-")
+    os.environ["CLASH_CONFIG_DIR"] = config_dir
+    os.environ["CLASH_EXTERNAL_CONTROLLER"] = f"127.0.0.1:{port}"
+    os.environ["AUTO_SET_PROXY"] = "false"
+    return config_dir
+
+async def bench_proxy(requests: int = 2000) -> dict:
+    from main import proxy_clash_api
+    from starlette.requests import Request
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    def make_request():
+        return Request({
+            "type": "http", "method": "GET", "path": "/api/version",
+            "query_string": b"", "headers": [(b"host", b"bench")]
+        }, receive)
+
+    async def call():
+        response = await proxy_clash_api("version", make_request())
+        # Streaming responses only hit the controller when the body is consumed
+        if hasattr(response, "body_iterator"):
+            async for _ in response.body_iterator:
+                pass
+            if response.background:
+                await response.background()
+
+    # The proxy's debug prints and request logs would drown the report
+    logging.disable(logging.CRITICAL)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        # Warm up the pool and any caches
+        for _ in range(20):
+            await call()
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        for _ in range(requests):
+            await call()
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+    logging.disable(logging.NOTSET)
+    return {"rps": requests / wall, "cpu_ms": cpu / requests * 1000}
+
+def report(label: str, result: dict):
+    print(f"{label}: {result['rps']:.0f} req/s, {result['cpu_ms']:.2f} ms backend CPU per request")
+
+if __name__ == "__main__":
+    stub, port = start_stub_controller()
+    prepare_environment(port)
+    try:
+        print("=" * 60)
+        print("Benchmarking GET /api/version through the controller proxy")
+        print("=" * 60)
+        report("proxy_clash_api", asyncio.run(bench_proxy()))
+    finally:
+        stub.terminate()
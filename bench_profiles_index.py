@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the /api proxy with a large profiles.json: every proxied request
+resolves the controller from the profile index, so reading the index from
+disk on each request shows up directly in req/s and CPU per request.
+
+Run it on two checkouts to compare them.
+"""
+import asyncio
+import json
+import os
+import sys
+
+from bench_controller_client import bench_proxy, prepare_environment, report, start_stub_controller
+
+PROFILE_COUNT = 200
+
+def write_profiles(config_dir: str, count: int):
+    profiles = [
+        {
+            "id": f"bench-{i}",
+            "name": f"Bench Profile {i}",
+            "type": "remote",
+            "url": f"https://example.com/sub/{i}?token=bench",
+            "file": f"bench-{i}.yaml",
+            "updated": 0,
+            "usage": {"upload": 0, "download": 0, "total": 0, "expire": 0},
+            "interval": 1440
+        }
+        for i in range(count)
+    ]
+    with open(os.path.join(config_dir, "profiles.json"), "w", encoding="utf-8") as f:
+        json.dump({"profiles": profiles, "selected": profiles[0]["id"]}, f, indent=2)
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else PROFILE_COUNT
+    stub, port = start_stub_controller()
+    config_dir = prepare_environment(port)
+    write_profiles(config_dir, count)
+    try:
+        print("=" * 60)
+        print(f"Benchmarking GET /api/version with {count} profiles in the index")
+        print("=" * 60)
+        report("proxy_clash_api", asyncio.run(bench_proxy()))
+    finally:
+        stub.terminate()
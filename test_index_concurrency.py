@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Stress test of concurrent profile index mutations: renames, subscription
+refreshes and deletes interleaved on one event loop, then checked against a
+fresh load of the index from disk.
+
+Usage: python test_index_concurrency.py [json|sqlite]
+"""
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Add parent directory to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'apps', 'server'))
+
+PROFILE_COUNT = 20
+DELETE_COUNT = 5
+ROUNDS = 5
+SUBSCRIPTION_BODY = b"proxies: []\n"
+
+async def handle_subscription(reader, writer):
+    """Subscription source answering every GET with an empty proxy list after a short delay"""
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        await asyncio.sleep(0.02)
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/yaml\r\nConnection: close\r\n"
+            b"Content-Length: " + str(len(SUBSCRIPTION_BODY)).encode() + b"\r\n\r\n" + SUBSCRIPTION_BODY
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def test_index_concurrency():
+    # Import after the config dir is set
+    import main
+
+    server = await asyncio.start_server(handle_subscription, "127.0.0.1", 0)
+    url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/sub"
+
+    index = main.load_index()
+    for i in range(PROFILE_COUNT + DELETE_COUNT):
+        index.profiles.append(main.Profile(
+            id=f"p{i}", name=f"Profile {i}", type="remote", url=url,
+            file=f"p{i}.yaml", updated=0, usage={}
+        ))
+    main.save_index(index)
+
+    expected = {}
+
+    async def rename(i):
+        for r in range(ROUNDS):
+            await asyncio.sleep(random.random() * 0.05)
+            expected[f"p{i}"] = (f"renamed-{i}-{r}", 10 + r)
+            await main.patch_profile(f"p{i}", main.ProfileUpdate(name=f"renamed-{i}-{r}", interval=10 + r))
+
+    async def refresh(i):
+        for _ in range(ROUNDS):
+            await asyncio.sleep(random.random() * 0.05)
+            await main.perform_profile_update(f"p{i}")
+
+    async def delete(i):
+        await asyncio.sleep(random.random() * 0.2)
+        await main.delete_profile(f"p{i}")
+
+    tasks = [rename(i) for i in range(PROFILE_COUNT)]
+    tasks += [refresh(i) for i in range(PROFILE_COUNT)]
+    tasks += [delete(i) for i in range(PROFILE_COUNT, PROFILE_COUNT + DELETE_COUNT)]
+
+    started = time.perf_counter()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    server.close()
+
+    # Verify against what actually reached disk, not the in-memory cache
+    main.index_store.close()
+    on_disk = {p.id: p for p in main.make_index_store().load().profiles}
+
+    lost = [
+        pid for pid, (name, interval) in expected.items()
+        if pid not in on_disk
+        or on_disk[pid].name != name
+        or on_disk[pid].interval != interval
+        or not on_disk[pid].content_hash
+    ]
+    resurrected = [
+        f"p{i}" for i in range(PROFILE_COUNT, PROFILE_COUNT + DELETE_COUNT)
+        if f"p{i}" in on_disk
+    ]
+
+    print(f"Operations: {PROFILE_COUNT * ROUNDS * 2 + DELETE_COUNT} in {elapsed:.2f}s")
+    print(f"Lost updates: {len(lost)}/{PROFILE_COUNT}", *lost)
+    print(f"Resurrected deletes: {len(resurrected)}/{DELETE_COUNT}", *resurrected)
+    return not lost and not resurrected
+
+if __name__ == "__main__":
+    backend = sys.argv[1] if len(sys.argv) > 1 else "json"
+    os.environ["CLASH_CONFIG_DIR"] = tempfile.mkdtemp(prefix="clashwebui-index-")
+    os.environ["AUTO_SET_PROXY"] = "false"
+
+    import main
+    main.APP_CONFIG["advanced"]["index_backend"] = backend
+    main.index_store = main.make_index_store()
+    main.index_cache = None
+
+    print("=" * 60)
+    print(f"Testing concurrent profile index mutations ({backend} backend)")
+    print("=" * 60)
+    ok = asyncio.run(test_index_concurrency())
+    print("\n✓ SUCCESS: No lost updates or resurrected deletes" if ok else "\n✗ FAILED: Index mutations were lost")
+    sys.exit(0 if ok else 1)